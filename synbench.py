@@ -0,0 +1,1014 @@
+#!/usr/bin/python
+""" SynBench - Micro-benchmarks for SynGen
+
+SynBench times the hot spots of syngen.py against synthetic feed data,
+so changes can be measured before they reach the cron job.  Nothing is
+fetched from the network; feeds fetched over HTTP come from a server on
+the loopback interface.
+
+Execution
+---------
+
+Run it from the directory holding syngen.py:
+
+   # ./synbench.py [benchmark ...]
+
+Without arguments every benchmark is run.  Available benchmarks:
+
+   text     - title and description clean-up, per article, compared
+              with the SynGen 1.4 string functions
+   render   - message serialization, compared with the email.Message
+              code of SynGen 1.4; output is checked for conformance
+   rss      - rssToMbox() over parsed synthetic feeds
+   dupe     - checkDupe(), ArticleCache and SeenRing against new and
+              seen guids
+   write    - writeMailbox() appending to an mbox
+   feed     - processFeed() on local feed files, first run and repeat,
+              and with STREAMING switched, which must give the same
+              mbox
+   fetch    - fetchFeed() over HTTP with and without HTTP_POOL; both
+              must give the same links, relative ones resolved
+
+The synthetic feeds are RSS and Atom of several sizes, with and without
+guids, content blocks and enclosures; see FEEDS.  Feed state and
+mailboxes are written to a temporary directory which is removed
+afterwards.  Rates are given per article (or guid, or message) and in
+MB/sec of feed or mailbox data.
+
+Baselines
+---------
+
+Results can be saved and later runs compared against them:
+
+   # ./synbench.py -save before.txt
+   # ./synbench.py -compare before.txt
+
+With -compare every rate is shown next to the baseline, and the exit
+status is 1 if any has dropped by more than TOLERANCE.  Baselines only
+mean something on the machine they were saved on, and when it is idle;
+the 1.4 and email.Message reference rates show how much it varies.
+"""
+
+import sys, os, time, random, string, re, tempfile, shutil, threading
+import xml.sax.saxutils, email.Message, email, BaseHTTPServer
+
+import syngen, feedparser
+
+REPEAT = 3           # best of REPEAT runs is reported
+MIN_TIME = 0.2       # seconds each run is made to last at least
+TOLERANCE = 0.10     # slow down against a baseline reported as regression
+
+# synthetic feeds: label, kind ('rss' or 'atom'), articles, paragraphs
+# per article, then flags for guids, content blocks and enclosures
+FEEDS = [ ('rss small', 'rss', 20, 1, 1, 0, 0),
+          ('rss medium', 'rss', 200, 3, 1, 0, 1),
+          ('rss medium no guid', 'rss', 200, 3, 0, 0, 0),
+          ('rss large content', 'rss', 500, 5, 1, 1, 1),
+          ('atom medium', 'atom', 200, 3, 1, 1, 0),
+          ('atom large no guid', 'atom', 500, 5, 0, 1, 1) ]
+
+# Synthetic Data -------------------------------------------------------
+
+WORDS = string.split("""lorem ipsum dolor sit amet consectetur adipiscing
+   elit sed do eiusmod tempor incididunt ut labore et dolore magna aliqua
+   From &amp; &quot;quoted&quot; &rsquo;s &nbsp; caf\xc3\xa9""")
+
+def makeParagraph(rnd, words):
+   """
+   args: rnd - random.Random instance
+         words - number of words
+   output: none
+   returns: HTML paragraph string
+   """
+
+   out = []
+   for i in range(words):
+      word = rnd.choice(WORDS)
+      if not rnd.randint(0, 15):
+         word = '<a href="http://example.com/%d">%s</a>' % (i, word)
+      elif not rnd.randint(0, 20):
+         word = word + '\n'
+      out.append(word)
+
+   return '<p>' + string.join(out, ' ') + '</p>\n'
+
+def makeArticles(count, paragraphs, seed=1):
+   """
+   args: count - number of articles
+         paragraphs - paragraphs of text in each description
+         seed - random seed, same seed gives same articles
+   output: none
+   returns: list of (title, description) tuples, a third have no title
+   """
+
+   rnd = random.Random(seed)
+   articles = []
+
+   for i in range(count):
+      desc = ''
+      for j in range(paragraphs):
+         desc = desc + makeParagraph(rnd, rnd.randint(20, 80))
+      desc = unicode(desc, 'utf-8')
+
+      if i % 3:
+         title = u'Item %d &amp; <b>bold</b> &quot;caf\xe9&quot;' % i
+      else:
+         title = u''
+
+      articles.append((title, desc))
+
+   return articles
+
+def makeMessages(count, paragraphs, seed=1):
+   """
+   args: count - number of messages
+         paragraphs - paragraphs of text in each body
+         seed - random seed, same seed gives same messages
+   output: none
+   returns: list of dictionaries holding the rssToMbox() message fields
+            title, ititle, ilink, fileURL, guid, clink, date, desc
+   """
+
+   rnd = random.Random(seed)
+   titles = [ u'Plain Feed', u'Caf\xe9 Feed', u'A feed title that is ' + \
+              u'long enough to need folding somewhere along the line' ]
+   messages = []
+
+   for title, desc in makeArticles(count, paragraphs, seed):
+      ititle = syngen.articleTitle(title, desc)
+      if not rnd.randint(0, 5):
+         ititle = ititle + u' ' + ititle + u' ' + ititle
+      ilink = u'http://example.com/%d/%s' % (len(messages),
+                                            'x' * rnd.randint(0, 70))
+      if rnd.randint(0, 1):
+         fileURL = ilink + u'.mp3'
+      else:
+         fileURL = None
+
+      messages.append({ 'title': rnd.choice(titles), 'ititle': ititle,
+                        'ilink': ilink, 'fileURL': fileURL,
+                        'guid': u'%032x' % rnd.getrandbits(128),
+                        'clink': u'http://example.com/',
+                        'date': 'Fri Jun  4 12:00:00 2004',
+                        'desc': desc + '\nFrom the archive\n' })
+
+   return messages
+
+def _payload(m):
+   payload = u'<h4><a href="' + m['ilink'] + u'">'
+   payload += m['ititle'] + u'</a></h4>\n<p>\n'
+   payload += m['desc'] + u'\n</p>\n'
+   if m['fileURL']:
+      payload += u'<p>[<a href="' + m['fileURL'] + u'">Enclosure</a>]</p>'
+   return payload.encode('utf-8')
+
+def formatArticle(m):
+   """
+   args: m - message fields as returned by makeMessages()
+   output: none
+   returns: message in MBOX format, as rssToMbox() writes it
+   """
+
+   headers = [ ('From', '"' + m['title'] + '" <SynGen@SynGen.rss>'),
+               ('To', '"RSS eMail Reader" <blogger@SynGen.rss>'),
+               ('Subject', m['ititle']),
+               ('X-RSS-Link', m['ilink']) ]
+   if m['fileURL']:
+      headers.append(('X-RSS-Enclosure', m['fileURL']))
+   headers.append(('Message-ID', '<' + m['guid'] + '@' + m['clink'] + '>'))
+   headers.append(('Date', m['date']))
+
+   return syngen.formatMessage('SynGen@SynGen.rss ' + m['date'], headers,
+                               'text/html', 'utf-8', _payload(m)) + '\n\n'
+
+def _feedDate(kind, i):
+   when = time.gmtime(1086350400 - i * 3600)
+   if kind == 'atom':
+      return time.strftime('%Y-%m-%dT%H:%M:%SZ', when)
+   return time.strftime('%a, %d %b %Y %H:%M:%S GMT', when)
+
+def makeFeed(kind, count, paragraphs, guids=1, content=0, enclosures=0,
+             seed=1):
+   """
+   args: kind - 'rss' for RSS 2.0, 'atom' for Atom 1.0
+         count - number of articles
+         paragraphs - paragraphs of text in each article
+         guids - give each article a guid (RSS) or id (Atom)
+         content - carry the text in a content block as well as a
+                   description or summary
+         enclosures - give every other article an enclosure
+         seed - random seed, same seed gives same feed
+   output: none
+   returns: feed document, utf-8 encoded
+   """
+
+   esc = xml.sax.saxutils.escape
+   items = []
+
+   for i, (title, desc) in enumerate(makeArticles(count, paragraphs, seed)):
+      link = u'http://example.com/%s/%d' % (kind, i)
+      out = []
+
+      if kind == 'atom':
+         out.append(u'<entry><title type="html">%s</title>' % esc(title))
+         out.append(u'<link href="%s"/>' % link)
+         if guids:
+            out.append(u'<id>urn:syngen:%s:%d</id>' % (kind, i))
+         out.append(u'<updated>%s</updated>' % _feedDate(kind, i))
+         out.append(u'<summary type="html">%s</summary>' % esc(desc))
+         if content:
+            out.append(u'<content type="html">%s</content>' % esc(desc))
+         if enclosures and not i % 2:
+            out.append(u'<link rel="enclosure" href="%s.mp3" ' % link +
+                       u'length="1024" type="audio/mpeg"/>')
+         out.append(u'</entry>\n')
+      else:
+         out.append(u'<item><title>%s</title>' % esc(title))
+         out.append(u'<link>%s</link>' % link)
+         if guids:
+            out.append(u'<guid>%s#guid</guid>' % link)
+         out.append(u'<pubDate>%s</pubDate>' % _feedDate(kind, i))
+         out.append(u'<description>%s</description>' % esc(desc))
+         if content:
+            out.append(u'<content:encoded>%s</content:encoded>' % esc(desc))
+         if enclosures and not i % 2:
+            out.append(u'<enclosure url="%s.mp3" ' % link +
+                       u'length="1024" type="audio/mpeg"/>')
+         out.append(u'</item>\n')
+
+      items.append(string.join(out, u''))
+
+   if kind == 'atom':
+      head = u'<feed xmlns="http://www.w3.org/2005/Atom">' + \
+             u'<title>Synthetic Atom &amp; Co</title>' + \
+             u'<link href="http://example.com/"/><id>urn:syngen</id>' + \
+             u'<updated>%s</updated>\n' % _feedDate(kind, 0)
+      tail = u'</feed>\n'
+   else:
+      head = u'<rss version="2.0" ' + \
+             u'xmlns:content="http://purl.org/rss/1.0/modules/content/">' + \
+             u'<channel><title>Synthetic RSS &amp; Co</title>' + \
+             u'<link>http://example.com/</link>\n'
+      tail = u'</channel></rss>\n'
+
+   doc = u'<?xml version="1.0" encoding="utf-8"?>\n' + head + \
+         string.join(items, u'') + tail
+
+   return doc.encode('utf-8')
+
+def makeRelativeFeed(count):
+   """
+   args: count - number of articles
+   output: none
+   returns: RSS 2.0 feed document, utf-8 encoded, whose links and
+            images are all relative to where it is fetched from
+   """
+
+   esc = xml.sax.saxutils.escape
+   items = []
+
+   for i in range(count):
+      desc = u'<p>Post %d <a href="/post/%d/more">more</a> ' % (i, i) + \
+             u'<img src="img/%d.png"></p>' % i
+      items.append(u'<item><title>Post %d</title>' % i +
+                   u'<link>/post/%d</link>' % i +
+                   u'<guid isPermaLink="false">post-%d</guid>' % i +
+                   u'<pubDate>%s</pubDate>' % _feedDate('rss', i) +
+                   u'<description>%s</description></item>\n' % esc(desc))
+
+   doc = u'<?xml version="1.0" encoding="utf-8"?>\n' + \
+         u'<rss version="2.0"><channel><title>Relative Links</title>' + \
+         u'<link>/</link>\n' + string.join(items, u'') + \
+         u'</channel></rss>\n'
+
+   return doc.encode('utf-8')
+
+# Reference Implementations --------------------------------------------
+
+# The SynGen 1.4 string functions, kept as the baseline for comparison
+
+def legacyStripHtmlTags(text):
+   result = xml.sax.saxutils.unescape(text, syngen.ENTITY_DICT)
+   zapTagsRe = re.compile('<.+?>')
+   result = re.sub(zapTagsRe, '', result)
+   return result
+
+def legacyStripNewlines(text):
+   zapNewlinesRe = re.compile(r'(\n+|\r+)')
+   result = re.sub(zapNewlinesRe, ' ', text)
+   return result
+
+def legacyFirstNwords(text, count=7):
+   expr = '(.+?\s+){1,%d}' % count
+   fewWordsRe = re.compile(expr)
+   few = fewWordsRe.search(text)
+   if few != None:
+      result = legacyStripNewlines(few.group(0))
+   else:
+      result = text
+   return result
+
+def legacyArticleTitle(title, desc):
+   ititle = ""
+
+   if title:
+      ititle = legacyStripHtmlTags(title)
+
+   if not len(ititle):
+      ititle = legacyFirstNwords(legacyStripHtmlTags(desc)) + "..."
+
+   ititle = xml.sax.saxutils.unescape(ititle, syngen.ENTITY_DICT)
+
+   return string.strip(ititle)
+
+def legacyFormatArticle(m):
+   msg = email.Message.Message()
+   msg.set_unixfrom('From SynGen@SynGen.rss ' + m['date'])
+   msg.add_header('From', '"' + m['title'] + '" <SynGen@SynGen.rss>')
+   msg.add_header('To', '"RSS eMail Reader" <blogger@SynGen.rss>')
+   msg.add_header('Subject', m['ititle'])
+   msg.add_header('X-RSS-Link', m['ilink'])
+   if m['fileURL']:
+      msg.add_header('X-RSS-Enclosure', m['fileURL'])
+   msg.add_header('Message-ID', '<' + m['guid'] + '@' + m['clink'] + '>')
+   msg.add_header('Date', m['date'])
+   msg.set_type('text/html')
+   msg.set_charset('utf-8')
+   msg.epilogue = ''
+   msg.set_payload(_payload(m), 'utf-8')
+
+   output = msg.as_string(True)
+   output += '\n\n' # mbox seperator
+   return output
+
+def checkMessage(new, old, payload):
+   """
+   args: new - message from syngen.formatMessage()
+         old - the same message from email.Message
+         payload - body the message should carry
+   output: none
+   returns: None if new conforms, else a description of the difference
+
+   Headers must match old byte for byte.  The body is compared decoded,
+   as depending on the Python version email.Message may leave it
+   unencoded in spite of its Content-Transfer-Encoding header.
+   """
+
+   newHead = new[:new.index('\n\n')]
+   oldHead = old[:old.index('\n\n')]
+   if newHead != oldHead:
+      return 'headers differ:\n%s\n---\n%s' % (newHead, oldHead)
+
+   if new[-2:] != '\n\n' or email.message_from_string(new[:-2]). \
+         get_payload(decode=True) != payload:
+      return 'body differs'
+
+   for line in string.split(new[len(newHead):], '\n'):
+      if line[:5] == 'From ':
+         return 'unescaped From_ line in body'
+
+   return None
+
+# Timing Utilities -----------------------------------------------------
+
+def timeit(func, *args):
+   """
+   args: func - callable to time
+         args - its arguments
+   output: none
+   returns: (best seconds per call of REPEAT rounds, last result)
+
+   Quick calls are repeated until a round lasts MIN_TIME, so short
+   benchmarks are steady enough to compare against a baseline.
+   """
+
+   calls = 1
+   while 1:
+      start = time.time()
+      for i in range(calls):
+         result = func(*args)
+      elapsed = time.time() - start
+      if elapsed >= MIN_TIME or calls >= 100000:
+         break
+      calls = calls * 2
+
+   best = elapsed / calls
+   for i in range(REPEAT - 1):
+      start = time.time()
+      for j in range(calls):
+         result = func(*args)
+      elapsed = (time.time() - start) / calls
+      if elapsed < best:
+         best = elapsed
+
+   return best, result
+
+_results = {}        # label -> rate of every result reported
+
+def report(name, seconds, items, unit='article', size=None):
+   """
+   args: name - benchmark label
+         seconds - elapsed time
+         items - number of items processed
+         unit - name of an item
+         size - bytes processed, optional
+   output: one line of results
+   returns: none
+   """
+
+   if seconds:
+      rate = items / seconds
+   else:
+      rate = 0
+
+   line = "%-40s %10.1f us/%-7s %10.0f/sec" % \
+          (name, seconds * 1e6 / max(items, 1), unit, rate)
+   if size is not None and seconds:
+      line = line + " %8.2f MB/sec" % (size / seconds / 1e6)
+   print line
+
+   _results[name] = rate
+
+   return
+
+def saveBaseline(fname):
+   """
+   args: fname - file to write
+   output: none
+   returns: none / raise exception
+   """
+
+   names = _results.keys()
+   names.sort()
+
+   fp = file(fname, 'w')
+   for name in names:
+      fp.write("%s\t%f\n" % (name, _results[name]))
+   fp.close()
+
+   return
+
+def compareBaseline(fname):
+   """
+   args: fname - file written by saveBaseline()
+   output: each rate against the baseline
+   returns: 0 - no regressions, 1 - some rate dropped by over TOLERANCE
+   """
+
+   rc = 0
+   baseline = {}
+
+   fp = file(fname, 'r')
+   for line in fp.readlines():
+      name, rate = string.split(string.rstrip(line, '\n'), '\t')
+      baseline[name] = float(rate)
+   fp.close()
+
+   names = _results.keys()
+   names.sort()
+
+   print
+   print "%-40s %12s %12s %8s" % ('compared with ' + fname, 'baseline',
+                                 'now', 'change')
+
+   for name in names:
+      if not baseline.has_key(name) or not baseline[name]:
+         continue
+
+      change = _results[name] / baseline[name] - 1
+      if change < -TOLERANCE:
+         flag = '  REGRESSION'
+         rc = 1
+      else:
+         flag = ''
+
+      print "%-40s %12.0f %12.0f %+7.1f%%%s" % \
+            (name, baseline[name], _results[name], change * 100, flag)
+
+   return rc
+
+# Scratch Area Utilities -----------------------------------------------
+
+_scratch = None
+
+def scratchArea():
+   """
+   args: none
+   output: none
+   returns: temporary directory syngen has been pointed at
+
+   Feed state and mailboxes of the benchmarks go here, never to the
+   configured VAR and MAILDIR.
+   """
+
+   global _scratch
+
+   if _scratch is None:
+      _scratch = tempfile.mkdtemp('.synbench')
+
+      syngen.BLOGLINES = False
+      syngen.VAR = _scratch + "/var"
+      syngen.MODIFIED = syngen.VAR + "/modified"
+      syngen.CACHE = syngen.VAR + "/cache"
+      syngen.RUNFILE = syngen.VAR + "/lastrun"
+      syngen.STATEDB = syngen.VAR + "/state"
+      syngen.MAILDIR = _scratch + "/mail"
+
+      for dir in (syngen.MODIFIED, syngen.CACHE, syngen.MAILDIR):
+         os.makedirs(dir)
+
+   return _scratch
+
+def removeScratchArea():
+   global _scratch
+
+   stopFeedServer()
+
+   if _scratch is not None:
+      syngen.closeState()
+      shutil.rmtree(_scratch, True)
+      _scratch = None
+
+   return
+
+def feedFiles():
+   """
+   args: none
+   output: none
+   returns: list of (label, file name, size, articles) for FEEDS, the
+            feeds written to the scratch area
+   """
+
+   feeds = []
+
+   for label, kind, count, paragraphs, guids, content, enc in FEEDS:
+      doc = makeFeed(kind, count, paragraphs, guids, content, enc)
+      fname = "%s/%s.xml" % (scratchArea(), string.replace(label, ' ', '_'))
+
+      fp = file(fname, 'w')
+      fp.write(doc)
+      fp.close()
+
+      feeds.append((label, fname, len(doc), count))
+
+   return feeds
+
+def resetState(name):
+   """
+   args: name - base name of the feed state and mbox to remove
+   output: none
+   returns: none
+   """
+
+   for path in (syngen.MODIFIED + "/" + name, syngen.CACHE + "/" + name):
+      try:
+         syngen.removeState(path)
+      except:
+         pass
+   syngen.syncState()
+
+   mbox = syngen.MAILDIR + "/" + name
+   for path in (mbox, mbox + syngen.INDEX_SUFFIX):
+      if os.path.exists(path):
+         os.unlink(path)
+
+   return
+
+# Feed Server Utilities ------------------------------------------------
+
+class FeedRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+   """
+   Serves the files of the scratch area by their base name.
+   """
+
+   def do_GET(self):
+      fname = scratchArea() + "/" + os.path.basename(self.path)
+      if not os.path.isfile(fname):
+         self.send_error(404)
+         return
+
+      doc = file(fname).read()
+      self.send_response(200)
+      self.send_header('Content-Type', 'application/rss+xml')
+      self.send_header('Content-Length', str(len(doc)))
+      self.end_headers()
+      self.wfile.write(doc)
+
+   def log_message(self, *args):
+      pass
+
+_server = None
+
+def feedServer():
+   """
+   args: none
+   output: none
+   returns: base url of an HTTP server on the loopback interface
+            serving the scratch area
+   """
+
+   global _server
+
+   if _server is None:
+      scratchArea()
+      _server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0),
+                                          FeedRequestHandler)
+      thread = threading.Thread(target=_server.serve_forever)
+      thread.setDaemon(1)
+      thread.start()
+
+   return "http://127.0.0.1:%d/" % _server.server_address[1]
+
+def stopFeedServer():
+   global _server
+
+   if _server is not None:
+      _server.shutdown()
+      _server.server_close()
+      _server = None
+
+   return
+
+# Benchmarks -----------------------------------------------------------
+
+def _titles(titleFunc, articles):
+   return [titleFunc(title, desc) for title, desc in articles]
+
+def benchText():
+   """
+   args: none
+   output: per-article cost of title clean-up, before and after
+   returns: 0 - outputs match, 1 - outputs differ
+   """
+
+   rc = 0
+
+   for paragraphs in (1, 10, 100):
+      articles = makeArticles(200, paragraphs)
+      label = "text, %d paragraph(s)" % paragraphs
+
+      old, expected = timeit(_titles, legacyArticleTitle, articles)
+      new, result = timeit(_titles, syngen.articleTitle, articles)
+
+      report(label + ", 1.4", old, len(articles))
+      report(label + ", current", new, len(articles))
+
+      if result != expected:
+         print "%s: output differs from SynGen 1.4" % label
+         rc = 1
+
+      descs = [desc for title, desc in articles]
+      size = len(string.join(descs, u'').encode('utf-8'))
+
+      elapsed, texts = timeit(map, syngen.stripHtmlTags, descs)
+      report(label + ", stripHtmlTags", elapsed, len(descs), 'article',
+             size)
+
+      elapsed, result = timeit(map, syngen.firstNwords, texts)
+      report(label + ", firstNwords", elapsed, len(texts), 'article')
+
+   return rc
+
+def _format(formatFunc, messages):
+   return [formatFunc(m) for m in messages]
+
+def benchRender():
+   """
+   args: none
+   output: per-message cost of serialization, before and after
+   returns: 0 - output conforms, 1 - it does not
+   """
+
+   rc = 0
+
+   for paragraphs in (1, 10):
+      messages = makeMessages(300, paragraphs)
+      label = "render, %d paragraph(s)" % paragraphs
+
+      old, expected = timeit(_format, legacyFormatArticle, messages)
+      new, result = timeit(_format, formatArticle, messages)
+
+      size = len(string.join(result, ''))
+      report(label + ", email.Message", old, len(messages), 'message',
+             size)
+      report(label + ", current", new, len(messages), 'message', size)
+
+      for i in range(len(messages)):
+         problem = checkMessage(result[i], expected[i],
+                                _payload(messages[i]))
+         if problem:
+            print "%s: message %d does not conform, %s" % (label, i, problem)
+            rc = 1
+            break
+
+   return rc
+
+def benchRss():
+   """
+   args: none
+   output: cost of rendering each synthetic feed with rssToMbox()
+   returns: 0 - success, 1 - an article was lost
+   """
+
+   rc = 0
+
+   for label, fname, size, count in feedFiles():
+      data = feedparser.parse(fname)
+
+      elapsed, output = timeit(syngen.rssToMbox, data)
+      report("rss, " + label, elapsed, count, 'article', size)
+
+      if len(syngen.splitMessages(output)) != count:
+         print "rss, %s: expected %d messages" % (label, count)
+         rc = 1
+
+   return rc
+
+def _cacheCheck(cfile, guids, reset):
+   if reset:
+      try:
+         syngen.removeState(cfile)
+      except:
+         pass
+
+   cache = syngen.articleCache(cfile)
+   dupes = 0
+   for guid in guids:
+      dupes = dupes + cache.checkDupe(guid)
+   cache.save()
+
+   return dupes
+
+def _fileCheck(cfile, guids, reset):
+   if reset:
+      try:
+         syngen.removeState(cfile)
+      except:
+         pass
+
+   dupes = 0
+   for guid in guids:
+      dupes = dupes + syngen.checkDupe(cfile, guid)
+
+   return dupes
+
+def benchDupe():
+   """
+   args: none
+   output: per-guid cost of duplicate checks, for new and seen articles
+   returns: 0 - success, 1 - duplicates miscounted
+   """
+
+   rc = 0
+   scratchArea()
+   cfile = syngen.CACHE + "/dupe"
+   format = syngen.HISTORY_FORMAT
+
+   tests = []
+   for count in (50, syngen.MAX_CACHE_ENTRIES):
+      tests.append(('text', count, _cacheCheck, "ArticleCache"))
+      tests.append(('text', count, _fileCheck, "checkDupe"))
+   for count in (50, syngen.MAX_CACHE_ENTRIES, syngen.HISTORY_ENTRIES):
+      tests.append(('ring', count, _cacheCheck, "SeenRing"))
+
+   for history, count, check, name in tests:
+      guids = [ u'http://example.com/dupe/%d#guid' % i for i in range(count) ]
+      label = "dupe, %d guids" % count
+      syngen.HISTORY_FORMAT = history
+
+      elapsed, dupes = timeit(check, cfile, guids, 1)
+      report("%s, %s, new" % (label, name), elapsed, count, 'guid')
+      if dupes:
+         print "%s, %s: %d new guids taken as seen" % (label, name, dupes)
+         rc = 1
+
+      elapsed, dupes = timeit(check, cfile, guids, 0)
+      report("%s, %s, seen" % (label, name), elapsed, count, 'guid')
+      if dupes != count:
+         print "%s, %s: %d of %d seen guids taken as new" % \
+               (label, name, count - dupes, count)
+         rc = 1
+
+      syngen.removeState(cfile)
+
+   syngen.HISTORY_FORMAT = format
+   syngen.syncState()
+
+   return rc
+
+def _writeEach(mbox, messages):
+   resetState(os.path.basename(mbox))
+   for msg in messages:
+      syngen.writeMailbox(mbox, msg)
+
+def _writeAll(mbox, messages):
+   resetState(os.path.basename(mbox))
+   syngen.writeMailbox(mbox, string.join(messages, ''))
+
+def benchWrite():
+   """
+   args: none
+   output: per-message cost of appending to an mbox
+   returns: 0 - success, 1 - mbox is not what was written
+   """
+
+   rc = 0
+   scratchArea()
+   mbox = syngen.MAILDIR + "/write"
+
+   for paragraphs in (1, 10):
+      messages = map(formatArticle, makeMessages(300, paragraphs))
+      size = len(string.join(messages, ''))
+      label = "write, %d paragraph(s)" % paragraphs
+
+      elapsed, result = timeit(_writeEach, mbox, messages)
+      report(label + ", per message", elapsed, len(messages), 'message',
+             size)
+
+      elapsed, result = timeit(_writeAll, mbox, messages)
+      report(label + ", one batch", elapsed, len(messages), 'message',
+             size)
+
+      if os.path.getsize(mbox) != size:
+         print "%s: mbox holds %d bytes, expected %d" % \
+               (label, os.path.getsize(mbox), size)
+         rc = 1
+
+   resetState("write")
+
+   return rc
+
+def _processFeed(fname, name, reset):
+   if reset:
+      resetState(name)
+
+   syngen.processFeed(fname, syngen.MAILDIR + "/" + name,
+                      syngen.MODIFIED + "/" + name, syngen.CACHE + "/" + name)
+   syngen.flushMailboxes()
+   syngen.syncState()
+
+def _streamFeed(fname, name, stream):
+   streaming = syngen.STREAMING
+   syngen.STREAMING = stream
+   try:
+      _processFeed(fname, name, 1)
+   finally:
+      syngen.STREAMING = streaming
+
+def benchFeed():
+   """
+   args: none
+   output: cost of processFeed() on each synthetic feed, the first time
+           with no state and again with every article already seen, and
+           the first time with STREAMING switched
+   returns: 0 - success, 1 - articles lost or repeated, or STREAMING
+            changes the mbox
+   """
+
+   rc = 0
+
+   for label, fname, size, count in feedFiles():
+      name = os.path.basename(fname)
+      mbox = syngen.MAILDIR + "/" + name
+
+      elapsed, result = timeit(_processFeed, fname, name, 1)
+      report("feed, %s, first" % label, elapsed, count, 'article', size)
+
+      first = file(mbox).read()
+      messages = len(syngen.splitMessages(first))
+      if messages != count:
+         print "feed, %s: %d messages written, expected %d" % \
+               (label, messages, count)
+         rc = 1
+
+      written = os.path.getsize(mbox)
+
+      elapsed, result = timeit(_processFeed, fname, name, 0)
+      report("feed, %s, repeat" % label, elapsed, count, 'article', size)
+
+      # the cache only remembers MAX_CACHE_ENTRIES articles per feed
+      if count <= syngen.MAX_CACHE_ENTRIES and \
+            os.path.getsize(mbox) != written:
+         print "feed, %s: seen articles written again" % label
+         rc = 1
+
+      resetState(name)
+
+      # the same messages whether the feed is parsed as it is read or not
+      stream = not syngen.STREAMING
+      elapsed, result = timeit(_streamFeed, fname, name, stream)
+      report("feed, %s, %s" % (label, ('feedparser', 'streaming')[stream]),
+             elapsed, count, 'article', size)
+
+      if file(mbox).read() != first:
+         print "feed, %s: mbox differs with STREAMING %s" % (label, stream)
+         rc = 1
+
+      resetState(name)
+
+   return rc
+
+def _fetchFeed(url, pool):
+   syngen.HTTP_POOL = pool
+   return syngen.fetchFeed(url)
+
+def feedLinks(data):
+   """
+   args: data - feedparser data dictionary
+   output: none
+   returns: list of the feed link, then the link, summary and content
+            of every entry
+   """
+
+   links = [ data['feed'].get('link') ]
+
+   for entry in data['entries']:
+      links.append(entry.get('link'))
+      links.append(entry.get('summary'))
+      for content in entry.get('content', []):
+         links.append(content.get('value'))
+
+   return links
+
+def benchFetch():
+   """
+   args: none
+   output: cost of fetchFeed() on each synthetic feed served over HTTP,
+           with and without HTTP_POOL
+   returns: 0 - success, 1 - the two differ
+   """
+
+   rc = 0
+   pool = syngen.HTTP_POOL
+
+   feeds = feedFiles()
+   doc = makeRelativeFeed(20)
+   fname = scratchArea() + "/rss_relative_links.xml"
+   fp = file(fname, 'w')
+   fp.write(doc)
+   fp.close()
+   feeds.append(('rss relative links', fname, len(doc), 20))
+
+   try:
+      for label, fname, size, count in feeds:
+         url = feedServer() + os.path.basename(fname)
+
+         elapsed, pooled = timeit(_fetchFeed, url, True)
+         report("fetch, %s, pooled" % label, elapsed, count, 'article',
+                size)
+
+         elapsed, plain = timeit(_fetchFeed, url, False)
+         report("fetch, %s, urllib" % label, elapsed, count, 'article',
+                size)
+
+         if feedLinks(pooled) != feedLinks(plain):
+            print "fetch, %s: links differ with HTTP_POOL" % label
+            rc = 1
+   finally:
+      syngen.HTTP_POOL = pool
+
+   return rc
+
+BENCHMARKS = [ ('text', benchText), ('render', benchRender),
+               ('rss', benchRss), ('dupe', benchDupe),
+               ('write', benchWrite), ('feed', benchFeed),
+               ('fetch', benchFetch) ]
+
+# ----------------------------------------------------------------------
+
+def main():
+   """
+   args: uses sys.argv if exists
+   output: benchmark results
+   returns: 0 - success, 1 - fail - uses sys.exit()
+   """
+
+   names = sys.argv[1:]
+   save = compare = None
+   rc = 0
+
+   while names and names[0] in ('-save', '-compare') and len(names) > 1:
+      if names[0] == '-save':
+         save = names[1]
+      else:
+         compare = names[1]
+      names = names[2:]
+
+   try:
+      for name, bench in BENCHMARKS:
+         if not names or name in names:
+            if bench():
+               rc = 1
+   finally:
+      removeScratchArea()
+
+   if save:
+      saveBaseline(save)
+
+   if compare and compareBaseline(compare):
+      rc = 1
+
+   sys.exit(rc)
+
+if __name__ == '__main__':
+   main()
@@ -36,6 +36,54 @@ the 'User Configuration' section (see below).
 Additionally, be sure to modify the first line to point to the correct
 location of your Python interpreter (see above).
 
+Large feed lists may be fetched concurrently by raising WORKERS in the
+'System Configuration' section.  HOST_WORKERS limits how many of those
+fetches may hit the same web site at once.  On machines with several
+CPUs, PROCESS_POOL also moves parsing and rendering into worker
+processes (Python 2.6 or later).
+
+Setting STATE_BACKEND to 'dbm' keeps all per-feed state in a single
+database instead of two small files per feed.  Existing state under VAR
+is copied into the database the first time it is opened.
+
+Set MAILBOX_FORMAT to 'maildir' to have each mailbox written as a
+Maildir instead: a directory with every message in a file of its own.
+Nothing is locked to deliver to a Maildir, and IMAP servers pick up new
+messages without reading through the whole mailbox.  MBOX_INDEX,
+-reindex and -maintain only apply to mbox files.
+
+FLUSH_POLICY controls how often each mbox is locked and appended to:
+after every feed, once per run, or whenever FLUSH_SIZE bytes are queued.
+
+With ADAPTIVE_POLLING set, each feed is only fetched when it is due.
+SynGen learns how often a feed changes and polls it about that often,
+never more than once per MIN_POLL_INTERVAL and at least once per
+MAX_POLL_INTERVAL.  Keep running SynGen from cron as before.
+
+Set METRICS to have the time spent on each feed, by stage, and its
+article counts written at the end of every run: as JSON lines to
+METRICSFILE and for Prometheus' node exporter to PROMFILE.  Point
+PROMFILE into the exporter's --collector.textfile.directory.
+
+For very large feeds set STREAMING: feeds are then parsed as they are
+downloaded and written out FLUSH_SIZE bytes at a time, so memory use
+does not grow with the size of the feed.  Streaming needs well formed
+XML and, with WORKERS above 1, still holds each feed's new articles
+until they are written.
+
+With BLOGLINES set, a run first asks Bloglines for the unread count
+and stops there when nothing is unread.  The subscription list is kept
+in VAR and read again once it is BLOGLINES_REFRESH seconds old or a
+subscription has gone; items are fetched BLOGLINES_PIPELINE
+subscriptions at a time over one connection.
+
+Fetches time out after FETCH_CONNECT_TIMEOUT and FETCH_READ_TIMEOUT.  A
+feed that fails is fetched less and less often, from FAIL_BACKOFF up to
+FAIL_BACKOFF_MAX apart, and its error is mailed once rather than every
+run, with a note when it works again.  After HOST_FAILURES failed
+fetches in a row from one host, its feeds are skipped for HOST_RETRY
+seconds.
+
 Execution
 ---------
 
@@ -50,10 +98,62 @@ may be used to execute SynGen hourly:
 
    0 * * * * /path/to/SynGen/syngen.py
 
+Instead of cron, SynGen can be left running as a daemon.  It then reads
+the feed list and feed state once, fetches each feed when it is due and
+notices changes to FEEDFILE by itself.  Send it SIGHUP to re-read the
+feed list at once, SIGTERM to make it write out its state and exit:
+
+   # nohup ./syngen.py -daemon > syngen.log 2>&1 &
+
 Additionally, periodic cleaning up of the cache is wise:
 
    30 1 * * * /path/to/SynGen/syngen.py -cleanup
 
+Mailboxes only ever grow unless they are maintained.  Set ROTATE_SIZE
+or ROTATE_AGE, and RETENTION, and add a job like this:
+
+   45 1 * * 0 /path/to/SynGen/syngen.py -maintain [mbox ...]
+
+It rotates large or old mailboxes to mbox.1, mbox.2 ... and removes
+messages older than RETENTION, by their Date header, from the mailboxes
+and their rotated copies.  Mail readers should not have the mailboxes
+open while it runs.
+
+With ARCHIVE_AGE set, -maintain also moves messages older than that out
+of the mailboxes into compressed archive segments in ARCHIVEDIR.  They
+can be searched by Message-ID or Subject, and extracted in MBOX format:
+
+   # ./syngen.py -search mbox [text]
+   # ./syngen.py -extract mbox [message-id ...] > found.mbox
+
+With MBOX_INDEX set, SynGen keeps a Message-ID index next to each mbox.
+Indexes of existing mailboxes can be (re)built by hand:
+
+   # ./syngen.py -reindex [mbox ...]
+
+Sharing the work between several processes
+------------------------------------------
+
+With LEASES set, any number of SynGen processes may be started on the
+same feed list at once, from cron or as daemons.  They divide the feeds
+between them as they go, and feeds of a process that dies are picked up
+by the others once it is gone.
+
+Sharing the work between several hosts
+--------------------------------------
+
+A long feed list can be split between N hosts, each fetching and
+keeping state for only its share of the feeds.  Give every host the
+same FEEDFILE and its own VAR, and start host K (1 to N) with:
+
+   0 * * * * /path/to/SynGen/syngen.py -shard K/N
+   30 1 * * * /path/to/SynGen/syngen.py -shard K/N -cleanup
+
+-shard works with -daemon too.  A feed's shard depends only on its hash
+in the feed list, so it stays on the same host as feeds come and go.
+After changing N, run -cleanup on every host to drop the state of the
+feeds that moved away.
+
 Known Bugs
 ----------
 
@@ -143,32 +243,79 @@ BLOGPASS = 'blogpass'
 OPMLurl = 'http://rpc.bloglines.com/listsubs'
 feedUrl = 'http://rpc.bloglines.com/getitems?n=0&s='
 feedUrl = 'http://rpc.bloglines.com/getitems?n=1&s='
+updateUrl = 'http://rpc.bloglines.com/update?ver=1&user='
+
+# the subscription list is kept between runs and read again once it is
+# BLOGLINES_REFRESH seconds old; items are fetched BLOGLINES_PIPELINE
+# subscriptions at a time over one connection
+BLOGLINES_REFRESH = 24 * 60 * 60
+BLOGLINES_PIPELINE = 16
 
 BasicAuth = base64.encodestring('%s:%s' % (BLOGUSER, BLOGPASS))[:-1]
 
-# A SAX content handler that turns an OPML subscription list into a
-# dictionary indexed by Bloglines subid
+# A SAX content handler that turns an OPML subscription list into
+# dictionaries indexed by Bloglines subid, of every subscription (subs)
+# and of those with unread items (data)
 
 class OPMLHandler(xml.sax.ContentHandler):
    def startDocument(self):
       self.data = {}
+      self.subs = {}
       self.folder = ""
       
    def startElement(self,tag,attributes):
       if tag == 'outline':
          if attributes.has_key('xmlUrl'):
+            subid = str(attributes['BloglinesSubId'])
+            self.subs[subid] = self.folder
             if int(attributes['BloglinesUnread']) > 0:
-               self.data[attributes['BloglinesSubId']] = self.folder
+               self.data[subid] = self.folder
          else:
             self.folder = 'in_' + attributes['title'].lower()
          
-def getBLdata(subid):
+def openBL(url):
+   # pooled fetches behave like urllib2 and raise on HTTP errors
+   f = openURL(url, { 'Authorization': 'Basic %s' % BasicAuth })
+   if f.status > 399:
+      f.close()
+      if f.status in (404, 410):
+         forgetBLsubs()       # unsubscribed since the list was kept
+      raise IOError("received HTTP error %d: %s" % (f.status, url))
+   return f
+
+# None when the subscription has nothing unread (HTTP 304)
+
+def openBLdata(subid):
+
+   # most are already fetched, a batch at a time
+   found, data = prefetchedBL(subid)
+   if found:
+      if data is None: return None
+      return cStringIO.StringIO(data)
 
    url = feedUrl + subid
+   if pooledURL(url):
+      f = openBL(url)
+      if f.status == 304:
+         f.read()
+         f.close()
+         return None
+      return f
+
    req = urllib2.Request(url)
    req.add_header("Authorization", "Basic %s" % BasicAuth)
 
-   f = urllib2.urlopen(req)
+   try:
+      return urllib2.urlopen(req)
+   except urllib2.HTTPError, detail:
+      if detail.code == 304: return None
+      if detail.code in (404, 410): forgetBLsubs()
+      raise
+
+def getBLdata(subid):
+
+   f = openBLdata(subid)
+   if f is None: return ''
    xml = f.read()
    f.close()
 
@@ -179,10 +326,12 @@ def getBLfeeds(xmlUrl):
    parser = xml.sax.make_parser()
    parser.setContentHandler(OPMLHandler())
 
-   req = urllib2.Request(xmlUrl)
-   req.add_header("Authorization", "Basic %s" % BasicAuth)
-
-   f = urllib2.urlopen(req)
+   if pooledURL(xmlUrl):
+      f = openBL(xmlUrl)
+   else:
+      req = urllib2.Request(xmlUrl)
+      req.add_header("Authorization", "Basic %s" % BasicAuth)
+      f = urllib2.urlopen(req)
 
    BUFSIZE = 8192
    
@@ -194,15 +343,18 @@ def getBLfeeds(xmlUrl):
 
    f.close()
 
-   return parser._cont_handler.data
+   return parser._cont_handler.data, parser._cont_handler.subs
 
 _DEBUG = 0
 _NOUPDATE = 0
 
 # system libraries
 import sys, os, traceback
-import md5, fcntl, string, time, cPickle, re, glob, sets
-import email.Message, urllib, xml.sax.saxutils
+import md5, fcntl, string, time, cPickle, cStringIO, re, glob, sets
+import email.Message, email.Charset, email.Header, email.Utils, urllib, urlparse, xml.sax.saxutils
+import threading, Queue, anydbm, xml.sax.handler
+import httplib, socket, zlib, random, calendar, signal, errno
+import mmap, struct, tempfile
 
 # external libraries
 try:
@@ -212,6 +364,12 @@ except:
    print "please see: http://sourceforge.net/projects/feedparser/"
    sys.exit(1)
 
+# optional libraries
+try:
+   import multiprocessing    # Python 2.6 and later
+except ImportError:
+   multiprocessing = None
+
 HOME = os.environ.get('HOME')    # Users home directory
 
 # User Configuration ---------------------------------------------------
@@ -229,10 +387,159 @@ FEEDFILE = "/home/jerobins/public_html/docs/feedlist.txt"
 MODIFIED = VAR + "/modified"
 CACHE = VAR + "/cache"
 RUNFILE = VAR + "/lastrun"
+BLOGSUBS = VAR + "/bloglines"    # subscription list kept between runs
+
+# when queued mailbox output is written out
+#   'feed' - as soon as each feed is processed
+#   'run'  - once per mbox at the end of the run
+#   'size' - once FLUSH_SIZE bytes are queued for an mbox, rest at the end
+FLUSH_POLICY = 'feed'
+FLUSH_SIZE = 1024 * 1024
+
+# only fetch feeds that are due, polling each one about as often as it
+# has been seen to change, within MIN_POLL_INTERVAL and MAX_POLL_INTERVAL
+# seconds; POLL_JITTER spreads due times by that fraction
+ADAPTIVE_POLLING = False
+MIN_POLL_INTERVAL = 3600
+MAX_POLL_INTERVAL = 2 * 86400
+POLL_BACKOFF = 1.5       # interval growth when nothing new is found
+POLL_JITTER = 0.1
+POLL_SLACK = 300         # feeds due this soon are fetched now
+
+# fetch http and https feeds through a shared pool of keep-alive
+# connections, asking for compressed responses
+HTTP_POOL = True
+POOL_SIZE = 4                       # idle connections kept per host
+MAX_FETCH_BYTES = 32 * 1024 * 1024  # largest response accepted
+
+# fetches give up on a host that takes FETCH_CONNECT_TIMEOUT seconds to
+# connect or FETCH_READ_TIMEOUT seconds to send anything more; fetches
+# by urllib2 and feedparser use FETCH_READ_TIMEOUT for both
+FETCH_CONNECT_TIMEOUT = 20
+FETCH_READ_TIMEOUT = 60
+
+# a feed that fails is not fetched again for FAIL_BACKOFF seconds,
+# doubled with each failure in a row up to FAIL_BACKOFF_MAX.  Its error
+# is mailed when it starts failing or fails differently, and a note
+# when it works again.  0 fetches failing feeds every run.
+FAIL_BACKOFF = 30 * 60
+FAIL_BACKOFF_MAX = 2 * 86400
+
+# once HOST_FAILURES fetches in a row from a host could not connect,
+# timed out or got a 5xx status, its feeds are skipped for HOST_RETRY
+# seconds before one is tried again.  0 never skips a host.
+HOST_FAILURES = 3
+HOST_RETRY = 15 * 60
+
+# parse feeds incrementally as they are downloaded and hand articles to
+# the mailbox FLUSH_SIZE bytes at a time, instead of reading the whole
+# feed into memory first; needs well formed XML (RSS or Atom)
+STREAMING = False
+
+# how mailboxes are written
+#   'mbox'    - one file per mailbox, appended to under a lock
+#   'maildir' - one directory per mailbox, a file per message, no locks
+MAILBOX_FORMAT = 'mbox'
+
+# keep a sidecar index of offset, length and Message-ID for every
+# message appended to an mbox, stored in mbox + INDEX_SUFFIX
+MBOX_INDEX = False
+INDEX_SUFFIX = '.idx'
+
+# per feed and per run metrics (status, bytes, fetch, parse, render and
+# write time, article counts), written at the end of every run as JSON
+# lines appended to METRICSFILE and as a Prometheus textfile collector
+# file, PROMFILE; set either file to None to skip it
+METRICS = False
+METRICSFILE = VAR + "/metrics.jsonl"
+PROMFILE = VAR + "/syngen.prom"
+
+# -maintain: an mbox is rotated to mbox.1 (mbox.1 to mbox.2 and so on,
+# ROTATE_KEEP are kept) once it is larger than ROTATE_SIZE bytes or its
+# oldest message is more than ROTATE_AGE seconds old; messages older than
+# RETENTION seconds are removed.  0 turns each of them off.
+ROTATE_SIZE = 0
+ROTATE_AGE = 0
+ROTATE_KEEP = 4
+RETENTION = 0
+
+# -maintain: messages older than ARCHIVE_AGE seconds (0 is off) are moved
+# out of the mailboxes into compressed, append-only segments in
+# ARCHIVEDIR, NAME.0001.gz and on, each with an index NAME.0001.idx.
+# Messages are compressed ARCHIVE_BLOCK bytes at a time and a new segment
+# is started once one is larger than ARCHIVE_SEGMENT bytes; RETENTION
+# removes whole segments.
+ARCHIVE_AGE = 0
+ARCHIVEDIR = VAR + "/archive"
+ARCHIVE_BLOCK = 256 * 1024
+ARCHIVE_SEGMENT = 64 * 1024 * 1024
+
+# where feed state (MODIFIED and CACHE data) is kept
+#   'files' - one small file per feed in MODIFIED and CACHE
+#   'dbm'   - a single anydbm database, STATEDB, written once per run
+STATE_BACKEND = 'files'
+STATEDB = VAR + "/state"
 
 MAX_CACHE_ENTRIES = 200
 MIN_CACHE_ENTRIES = 75
 
+# stop going through a feed once EARLY_STOP entries in a row were among
+# the WATERMARK_SIZE newest it had last time, kept in MODIFIED; feeds
+# not listed newest first are always gone through in full.  0 is off.
+EARLY_STOP = 0
+WATERMARK_SIZE = 20
+
+# how the ids of the articles each feed had are kept in CACHE
+#   'text' - the last MAX_CACHE_ENTRIES ids, one per line
+#   'ring' - md5 digests of the last HISTORY_ENTRIES ids in a fixed size
+#            file mapped into memory; needs STATE_BACKEND 'files'
+# text caches are converted to rings as they are used; rings only keep
+# digests, so going back to 'text' starts each feed's history afresh
+HISTORY_FORMAT = 'text'
+HISTORY_ENTRIES = 4096
+
+# write an article carried by several feeds (planets and the like) only
+# once, recognized by its title and text or by its link.  DEDUPE_FILE
+# holds two Bloom filters of DEDUPE_SIZE bytes; once DEDUPE_ITEMS keys,
+# two per article, are in the newer one the older one is cleared.  At 16
+# bits a key about 1 in 1000 new articles is wrongly taken as seen.
+GLOBAL_DEDUPE = False
+DEDUPE_FILE = VAR + "/dedupe"
+DEDUPE_SIZE = 1024 * 1024
+DEDUPE_ITEMS = DEDUPE_SIZE * 8 / 16
+DEDUPE_MIN_WORDS = 20    # shorter or untitled texts are only known by link
+
+# let several SynGen processes on this host share the feed list: each
+# claims LEASE_BATCH feeds at a time through leases kept in LEASEDB, and
+# takes over feeds whose lease is LEASE_TIME seconds old or whose process
+# has died; needs STATE_BACKEND 'files'
+LEASES = False
+LEASEDB = VAR + "/leases"
+LEASE_TIME = 30 * 60
+LEASE_BATCH = 10
+
+# split the feed list between several hosts: (K, N) handles only the
+# feeds of shard K of N, K from 1 to N; usually given as -shard K/N
+SHARD = None
+
+# concurrent feed processing, 1 = process feeds one after another
+WORKERS = 1          # number of fetch/parse/render threads
+HOST_WORKERS = 2     # max simultaneous fetches against a single host
+
+# parse and render feeds in a pool of worker processes, so more than one
+# CPU is used; feeds are still fetched, deduplicated and written by this
+# process.  Needs the multiprocessing module and is not used together
+# with STREAMING.  PROCESSES = None starts one per CPU.
+PROCESS_POOL = False
+PROCESSES = None
+
+# -daemon mode: feeds not polled adaptively are fetched every
+# DAEMON_INTERVAL seconds, due feeds are looked for every DAEMON_TICK
+# seconds and state is written out every STATE_SYNC_INTERVAL seconds
+DAEMON_INTERVAL = 3600
+DAEMON_TICK = 60
+STATE_SYNC_INTERVAL = 300
+
 CURTIME = time.asctime(time.gmtime())
 
 ENTITY_DICT = { '&apos;': "'", '&acirc;': "'", '&amp;': '&',
@@ -277,7 +584,19 @@ def checkFirstRun():
    returns: 0 - Success, 1 - Fail
    """
 
-   if BLOGLINES: return
+   # Bloglines keeps no feed state, only its subscription list and the
+   # time of the last run
+   if BLOGLINES:
+      try:
+         if not os.path.isdir(VAR):
+            os.mkdir(VAR)
+         if not os.path.exists(RUNFILE):
+            fp = file(RUNFILE, "w")
+            fp.close()
+            os.utime(RUNFILE, (00000000, 00000000))
+      except (IOError, OSError):
+         return 1
+      return 0
 
    try:
       fp = file(RUNFILE, 'r')
@@ -291,6 +610,37 @@ def checkFirstRun():
 
 # System Utilities -----------------------------------------------------
 
+def parseShard(text):
+   """
+   args: text - shard as "K/N"
+   output: none
+   returns: (K, N) / raise ValueError
+   """
+
+   try:
+      k, n = map(int, string.split(text, '/'))
+   except:
+      raise ValueError("shard is not K/N: " + text)
+
+   if n < 1 or k < 1 or k > n:
+      raise ValueError("shard is not K/N with 1 <= K <= N: " + text)
+
+   return k, n
+
+def inShard(key):
+   """
+   args: key - feed hash field, or Bloglines subid
+   output: none
+   returns: 1 - feed belongs to this SHARD, or there is none, 0 - not
+   """
+
+   if not SHARD: return 1
+
+   k, n = SHARD
+
+   # md5 so every host, whatever its Python, puts a feed in one shard
+   return long(md5.new(key).hexdigest()[:8], 16) % n == k - 1
+
 def _debuglog(message):
    if _DEBUG: print message
    return
@@ -316,6 +666,52 @@ def formatExceptionInfo(maxTBlevel=5):
 
 # String Utilities -----------------------------------------------------
 
+# Patterns are compiled once.  Entity references are replaced with one
+# regular expression pass whenever that gives the same result as
+# xml.sax.saxutils.unescape(), which replaces them one name at a time;
+# only '&amp;' can produce new references, so such text takes the slow
+# path.
+
+_zapTagsRe = re.compile('<.+?>')
+_zapNewlinesRe = re.compile(r'(\n+|\r+)')
+_fewWordsRes = {}
+
+def _entityTable():
+   table = { '&lt;': '<', '&gt;': '>' }
+   fast = 1
+   for name, value in ENTITY_DICT.items():
+      if name == '&amp;': continue
+      if not re.match(r'&\w+;$', name) or '&' in value: fast = 0
+      table[name] = value
+
+   names = table.keys()
+   names.sort()
+   names = map(re.escape, names)
+   entityRe = re.compile(string.join(names, '|'))
+
+   return table, entityRe, fast
+
+_entities, _entityRe, _fastEntities = _entityTable()
+
+def _entityRepl(match):
+   return _entities[match.group(0)]
+
+def unescapeEntities(text):
+   """
+   args: text - string
+   output: none
+   returns: string with the entities of ENTITY_DICT, &lt; and &gt;
+            replaced, same as xml.sax.saxutils.unescape
+   """
+
+   if '&' not in text:
+      return text
+
+   if not _fastEntities or '&amp;' in text:
+      return xml.sax.saxutils.unescape(text, ENTITY_DICT)
+
+   return _entityRe.sub(_entityRepl, text)
+
 def stripHtmlTags(text):
    """
    args: text - string
@@ -323,9 +719,9 @@ def stripHtmlTags(text):
    returns: string with all tags removed
    """
 
-   result = xml.sax.saxutils.unescape(text, ENTITY_DICT)
-   zapTagsRe = re.compile('<.+?>')
-   result = re.sub(zapTagsRe, '', result)
+   result = unescapeEntities(text)
+   if '<' in result:
+      result = _zapTagsRe.sub('', result)
    return result
 
 def stripNewlines(text):
@@ -335,9 +731,16 @@ def stripNewlines(text):
    returns: string with all newlines replaced with spaces
    """
 
-   zapNewlinesRe = re.compile(r'(\n+|\r+)')
-   result = re.sub(zapNewlinesRe, ' ', text)
-   return result
+   if '\n' in text or '\r' in text:
+      text = _zapNewlinesRe.sub(' ', text)
+   return text
+
+def _fewWordsRe(count):
+   fewWordsRe = _fewWordsRes.get(count)
+   if fewWordsRe is None:
+      fewWordsRe = re.compile('(.+?\s+){1,%d}' % count)
+      _fewWordsRes[count] = fewWordsRe
+   return fewWordsRe
 
 def firstNwords(text, count=7):
    """
@@ -347,365 +750,3850 @@ def firstNwords(text, count=7):
    returns: string with up to count words of the original text
    """
 
-   expr = '(.+?\s+){1,%d}' % count
-   fewWordsRe = re.compile(expr)
-   few = fewWordsRe.search(text)
+   few = _fewWordsRe(count).search(text)
    if few != None:
       result = stripNewlines(few.group(0))
    else:
       result = text
    return result
 
+def summarize(text, count=7):
+   """
+   args: text - string, HTML allowed
+         count - number of words max
+   output: none
+   returns: firstNwords(stripHtmlTags(text), count)
+
+   Neither tags nor entities span lines, so the text is cleaned a few
+   lines at a time until the words found can no longer change.
+   """
+
+   fewWordsRe = _fewWordsRe(count)
+
+   size = 1024
+   while size < len(text):
+      cut = text.find('\n', size)
+      if cut == -1: break
+
+      part = stripHtmlTags(text[:cut + 1])
+      few = fewWordsRe.search(part)
+      if few != None and few.end() < len(part):
+         return stripNewlines(few.group(0))
+
+      size = size * 4
+
+   return firstNwords(stripHtmlTags(text), count)
+
+def articleTitle(title, desc):
+   """
+   args: title - article title, HTML allowed, may be empty
+         desc - article description, used when there is no title
+   output: none
+   returns: plain text subject for the article
+   """
+
+   ititle = ""
+
+   if title:
+      ititle = stripHtmlTags(title)
+
+   if not len(ititle):
+      ititle = summarize(desc) + "..."
+
+   ititle = unescapeEntities(ititle)
+
+   return string.strip(ititle)
+
 # Mailbox Utilities ----------------------------------------------------
 
 def writeMailbox(mbox, data):
    """
    args: mbox - filename
          data - text for output in MBOX format
-   output: to file mbox
+   output: to file mbox, or Maildir mbox if MAILBOX_FORMAT is 'maildir'
    returns: none / raise exception
    """
 
-   fp = file(mbox, 'a')
-   fd = fp.fileno()
-   fcntl.lockf(fd, fcntl.LOCK_EX)
-   fp.write(data)
+   if MAILBOX_FORMAT == 'maildir':
+      deliverMaildir(mbox, data)
+      return
+
+   while True:
+      # readable too, the index may have to be rebuilt from it
+      fp = file(mbox, 'a+')
+      fd = fp.fileno()
+      fcntl.lockf(fd, fcntl.LOCK_EX)
+
+      # -maintain may have rotated the mbox away while we waited
+      try:
+         current = os.stat(mbox).st_ino
+      except OSError:
+         current = None
+      if current == os.fstat(fd).st_ino:
+         break
+
+      fcntl.lockf(fd, fcntl.LOCK_UN)
+      fp.close()
+
+   if MBOX_INDEX:
+      fp.seek(0, 2)
+      offset = fp.tell()
+      fp.write(data)
+      fp.flush()
+      try:
+         appendIndex(mbox, fp, offset, data)
+      except:
+         print "Unable to update mailbox index:", mbox + INDEX_SUFFIX
+   else:
+      fp.write(data)
+
    fcntl.lockf(fd, fcntl.LOCK_UN)
    fp.close()
    return
 
-# Article Cache Utilities ----------------------------------------------
+_maildirCount = 0    # messages delivered by this process
 
-def saveArticleId(cfile, guid, truncate=0):
+def maildirName():
    """
-   args: cfile - file and path of cache file
-         guid - uniq hash of item data
-         truncate - 0 no, 1 yes
-   output: error string
-   returns: none
+   args: none
+   output: none
+   returns: unique file name for a new Maildir message
    """
 
-   if _NOUPDATE: return
+   global _maildirCount
 
-   out = guid + "\n"
+   _maildirCount += 1
+   now = time.time()
+   host = string.replace(socket.gethostname(), '/', '\\057')
+   host = string.replace(host, ':', '\\072')
 
-   if truncate:
-      mode = 'w'
-   else:
-      mode = 'a'
+   return "%d.M%dP%dQ%d.%s" % (int(now), int((now % 1) * 1000000),
+                               os.getpid(), _maildirCount, host)
 
-   try:
-      fp = file(cfile, mode)
-      fp.write(out)
+def deliverMaildir(maildir, data):
+   """
+   args: maildir - directory name
+         data - text in MBOX format
+   output: each message as its own file in maildir/new
+   returns: none / raise exception
+
+   Messages are written to maildir/tmp and renamed into maildir/new once
+   they are on disk, so readers never see part of one and no locking is
+   needed.
+   """
+
+   for subdir in ('tmp', 'new', 'cur'):
+      if not os.path.isdir(maildir + "/" + subdir):
+         os.makedirs(maildir + "/" + subdir, 0700)
+
+   for start, end in splitMessages(data):
+      # drop the From_ line and the blank lines that end an mbox message
+      msg = data[start:end]
+      msg = string.rstrip(msg[string.find(msg, '\n') + 1:], '\n') + '\n'
+
+      name = maildirName()
+      tmp = maildir + "/tmp/" + name
+
+      fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+      fp = os.fdopen(fd, 'w')
+      fp.write(msg)
+      fp.flush()
+      os.fsync(fd)
       fp.close()
-   except:
-      print "Error saving article id in file:", cfile
+
+      os.rename(tmp, maildir + "/new/" + name)
 
    return
 
-def checkDupe(cfile, guid):
+_spool = {}         # mbox -> list of queued MBOX text
+_spoolSize = {}     # mbox -> bytes queued
+
+def queueMailbox(mbox, data):
    """
-   args: cfile - file and path of cache file
-         guid - uniq hash of item data
-   output: none
-   returns: 1 - dupe, 0 - not dupe
+   args: mbox - filename
+         data - text for output in MBOX format
+   output: to file mbox, depending on FLUSH_POLICY
+   returns: none / raise exception
    """
 
-   try:
-      fp = file(cfile, 'r')
-   except:
-      # file does not exist, make a new one
-      saveArticleId(cfile, guid)
-      dupe = 0
-   else:
-      data = fp.read()
-      fp.close()
+   if FLUSH_POLICY == 'feed':
+      writeMailbox(mbox, data)
+      return
 
-      data = string.split(data) # string to list
+   _spool.setdefault(mbox, []).append(data)
+   _spoolSize[mbox] = _spoolSize.get(mbox, 0) + len(data)
 
-      dupe = data.count(guid)
+   if FLUSH_POLICY == 'size' and _spoolSize[mbox] >= FLUSH_SIZE:
+      flushMailbox(mbox)
 
-      if not dupe:
-         datlen = len(data)
+   return
 
-         if datlen > MAX_CACHE_ENTRIES:
-            goners = datlen - MIN_CACHE_ENTRIES
-            del data[0:goners]
+def flushMailbox(mbox):
+   """
+   args: mbox - filename
+   output: queued text to file mbox, one locked append
+   returns: none / raise exception
+   """
 
-            data.append(guid)
+   if _spool.has_key(mbox):
+      data = string.join(_spool[mbox], "")
+      del _spool[mbox]
+      del _spoolSize[mbox]
+      writeMailbox(mbox, data)
 
-            saveArticleId(cfile, string.join(data, '\n'), 1)
-         else:
-            saveArticleId(cfile, guid)
+   return
 
-   return dupe
+def flushMailboxes():
+   """
+   args: none
+   output: queued text to every mbox; error text on Fail
+   returns: 0 - Success, > 0 - number of mailboxes that failed
+   """
 
-# Feed Cache Utilities -------------------------------------------------
+   failed = 0
 
-def readMfile(mfile):
+   for mbox in _spool.keys():
+      try:
+         flushMailbox(mbox)
+      except:
+         print "Unable to write mailbox:", mbox
+         failed += 1
+
+   return failed
+
+# MBOX Index Utilities -------------------------------------------------
+
+# An index line is "offset<TAB>length<TAB>message-id" for each message in
+# the mbox, in file order.  The index is only ever appended to while the
+# mbox lock is held, and rebuilt whenever it does not end where the mbox
+# does.  The mbox is read through the file that holds the lock: lockf()
+# locks go when any file on the mbox is closed.
+
+_fromLineRe = re.compile('^From ', re.M)
+
+def splitMessages(data):
    """
-   args: mfile - file and path to last modified data
+   args: data - text in MBOX format
    output: none
-   returns: data dictionary with 'etag' and 'modified' values always set
+   returns: list of (start, end) offsets of each message in data
    """
 
-   data = { 'etag': None, 'modified': None }
+   starts = []
+   for match in _fromLineRe.finditer(data):
+      pos = match.start()
+      if pos == 0 or data[pos-2:pos] == '\n\n':
+         starts.append(pos)
 
-   try:
-      fp = file(mfile, 'r')
-   except:
-      pass
-   else:
-      try:
-         cuke = cPickle.Unpickler(fp).load()
-      except:
-         pass
+   bounds = []
+   for i in range(len(starts)):
+      if i + 1 < len(starts):
+         bounds.append((starts[i], starts[i+1]))
       else:
-         data = cuke
+         bounds.append((starts[i], len(data)))
 
-      fp.close()
-         
-   return data
+   return bounds
 
-def writeMfile(mfile, data):
+def messageId(lines):
    """
-   args: mfile - file and path to last modified data
-         data - feedparser data dictionary
+   args: lines - header lines of a message, From_ line included
    output: none
-   returns: 0 - Success, 1 - Fail
+   returns: value of the Message-ID header, '' if there is none
    """
 
-   if _NOUPDATE: return 0
+   msgid = None
 
-   data.setdefault('etag', None)
-   data.setdefault('modified', None)
+   for line in lines:
+      if msgid is not None:
+         if line[:1] in (' ', '\t'):
+            msgid = msgid + string.strip(line)
+            continue
+         break
+      if string.lower(line[:11]) == 'message-id:':
+         msgid = string.strip(line[11:])
 
-   output = {}
-   output['etag'] = data['etag']
-   output['modified'] = data['modified']
+   if msgid is None:
+      msgid = ''
+
+   return msgid
+
+def _indexLine(offset, length, msgid):
+   return '%d\t%d\t%s\n' % (offset, length, msgid)
+
+def _indexEnd(ifile):
+   """
+   args: ifile - file and path of mbox index
+   output: none
+   returns: mbox offset just past the last indexed message, None if the
+            index is missing or unreadable
+   """
 
    try:
-      fp = file(mfile, 'w')
+      fp = file(ifile, 'r')
    except:
-      rc = 1
-   else:
-      cPickle.Pickler(fp).dump(output)
-      fp.close()
-      rc = 0
+      return None
 
-   return rc
+   fp.seek(0, 2)
+   size = fp.tell()
+   fp.seek(max(0, size - 4096))
+   tail = fp.read()
+   fp.close()
 
-# Cache File Utilities -------------------------------------------------
+   if not size:
+      return 0
 
-def cacheCleanup():
+   lines = string.split(tail, '\n')
+   if len(lines) < 2 and size > len(tail):
+      return None
+
+   try:
+      offset, length, msgid = string.split(lines[-2], '\t', 2)
+      end = int(offset) + int(length)
+   except:
+      end = None
+
+   return end
+
+def _tempFile(path, mode):
    """
-   args: none
-   output: text with count of files removed
-   returns: none / raise exception
+   args: path - filename the temporary file is renamed to once written
+         mode - permission bits to give it
+   output: new empty file next to path, its name starting with a dot so
+           MAILDIR listings pass it by
+   returns: (filename, file object open for reading and writing) / raise
+            exception
    """
 
-   if BLOGLINES: return
+   dir, name = os.path.split(path)
+   fd, tmp = tempfile.mkstemp('.new', '.' + name + '.', dir or '.')
+   os.chmod(tmp, mode)
 
-   cnt = 0
+   return tmp, os.fdopen(fd, 'w+')
+
+def rebuildIndex(mbox, fp, size=None):
+   """
+   args: mbox - filename
+         fp - mbox open for reading and locked by the caller, read from
+              its start; it is left open, as closing any other file on
+              the mbox would drop the lock
+         size - only index the first size bytes, default whole file
+   output: mbox + INDEX_SUFFIX
+   returns: none / raise exception
+   """
+
+   ifile = mbox + INDEX_SUFFIX
+   tmp, out = _tempFile(ifile, os.fstat(fp.fileno()).st_mode & 0777)
 
    try:
-      data = getFeedInfo()
+      _writeIndex(fp, out, size)
+      out.close()
+      os.rename(tmp, ifile)
    except:
-      print "Unable to open FEEDFILE", FEEDFILE
-      sys.exit(1)
-   else:
-      current = []
-      for line in string.split(data):
-         url, hash, mfile = string.split(line, '|')
-         current.append(hash)
-      
-      os.chdir(CACHE)
-      exists = glob.glob("*")
-
-      curSet = sets.Set(current)
-      existsSet = sets.Set(exists)
-      extraSet = existsSet.difference(curSet)
+      out.close()
+      os.unlink(tmp)
+      raise
 
-      cnt = len(extraSet)
+   return
 
-      for hash in extraSet:
-         cfile = CACHE + "/" + hash
-         mfile = MODIFIED + "/" + hash
-         try:
-            os.unlink(cfile)
-            os.unlink(mfile)
-         except:
-            print "Unable to remove file:", hash
+def _writeIndex(fp, out, size):
+   fp.seek(0)
+
+   offset = 0
+   start = None        # offset of the message being read
+   headers = []        # its header lines
+   inHeaders = 0
+   blank = 1           # previous line was blank
+
+   while size is None or offset < size:
+      line = fp.readline()
+      if not line: break
+
+      if line[:5] == 'From ' and blank:
+         if start is not None:
+            out.write(_indexLine(start, offset - start, messageId(headers)))
+         start = offset
+         headers = []
+         inHeaders = 1
+      elif inHeaders:
+         if line == '\n':
+            inHeaders = 0
          else:
-            continue
+            headers.append(string.rstrip(line, '\n'))
 
-      print "SynGen: Removed %d cache files" % cnt
+      blank = (line == '\n')
+      offset += len(line)
 
-   return
+   if start is not None:
+      out.write(_indexLine(start, offset - start, messageId(headers)))
 
-# RSS Processing Functions ---------------------------------------------
+   return
 
-def reportFeedError(detail, url, mbox):
+def appendIndex(mbox, fp, offset, data):
    """
-   args: detail - detail string of error
-         url - RSS url 
-         mbox - name of mailbox
-   output: none
+   args: mbox - filename
+         fp - mbox open for reading and locked, as for rebuildIndex()
+         offset - position in mbox where data was appended
+         data - text just appended in MBOX format
+   output: mbox + INDEX_SUFFIX
    returns: none / raise exception
    """
 
-   validate = urllib.quote(url)
-   detail = str(detail)
+   ifile = mbox + INDEX_SUFFIX
 
-   msg = email.Message.Message()
-   msg.set_unixfrom('From SynGen@SynGen.rss ' + CURTIME)
-   msg.add_header('From', '"SynGen RSS Aggregator" <SynGen@SynGen.rss>')
-   msg.add_header('To', '"RSS eMail Reader" <blogger@SynGen.rss>')
-   msg.add_header('Subject', 'Error in RSS Feed')
-   msg.add_header('Message-ID', '<' + url + '@feederror.syngen.rss>')
-   msg.add_header('Date', CURTIME)
-   msg.set_type('text/plain')
-   msg.set_charset('iso-8859-1')
-   msg.epilogue = ''
-   payload = 'Problem parsing XML feed data.\n' + \
-            'Feed URL: ' + url + '\n' + \
-            'Error Detail: ' + detail + '\n' + \
-            'Check with Feed Validator: ' + \
-            'http://www.feedvalidator.org/check?url=' + validate + '\n'
-   payload = payload.encode('iso-8859-1')
-   msg.set_payload(payload, 'iso-8859-1')
+   end = _indexEnd(ifile)
+   if end is None and offset == 0:
+      end = 0
 
-   output = msg.as_string(True)
-   output += '\n\n' # mbox seperator
-   del msg
+   if end != offset:
+      rebuildIndex(mbox, fp, offset)
+
+   out = []
+   for start, stop in splitMessages(data):
+      head = data.find('\n\n', start, stop)
+      if head == -1: head = stop
+      lines = string.split(data[start:head], '\n')
+      out.append(_indexLine(offset + start, stop - start, messageId(lines)))
 
-   writeMailbox(mbox, output)
+   fp = file(ifile, 'a')
+   fp.write(string.join(out, ''))
+   fp.close()
 
    return
 
-def rssToMbox(data, cfile = False):
+def readIndex(mbox):
    """
-   args: data - feedparser data dictionary
-         cfile - file and path to previously seen articles
+   args: mbox - filename
    output: none
-   returns: output string
+   returns: dictionary of Message-ID -> (offset, length) / raise exception
    """
 
-   output = []
+   index = {}
 
-   title = data['feed']['title']
-   if not title:
-      title = '(untitled)'
+   fp = file(mbox + INDEX_SUFFIX, 'r')
+   for line in fp.readlines():
+      offset, length, msgid = string.split(string.rstrip(line, '\n'), '\t', 2)
+      index[msgid] = (int(offset), int(length))
+   fp.close()
 
-   title = stripNewlines(string.strip(title))
-   title = xml.sax.saxutils.unescape(title, ENTITY_DICT)
+   return index
+
+def readMessage(mbox, msgid, index=None):
+   """
+   args: mbox - filename
+         msgid - Message-ID, angle brackets included
+         index - result of readIndex(mbox), read if not given
+   output: none
+   returns: message text in MBOX format, None if not indexed or the
+            index is out of date / raise exception
+   """
+
+   if index is None:
+      index = readIndex(mbox)
+
+   if not index.has_key(msgid):
+      return None
+
+   offset, length = index[msgid]
+
+   fp = file(mbox, 'r')
+   fp.seek(offset)
+   text = fp.read(length)
+   fp.close()
+
+   if text[:5] != 'From ':
+      return None
+
+   return text
+
+def reindexMailboxes(names):
+   """
+   args: names - list of mbox names in MAILDIR, all mailboxes if empty
+   output: text with count of indexes rebuilt
+   returns: none
+   """
+
+   if not names:
+      for path in glob.glob(MAILDIR + "/*"):
+         if os.path.isfile(path) and path[-len(INDEX_SUFFIX):] != INDEX_SUFFIX:
+            names.append(os.path.basename(path))
+
+   cnt = 0
+
+   for name in names:
+      mbox = MAILDIR + "/" + name
+      try:
+         fp = file(mbox, 'r')
+         try:
+            fcntl.lockf(fp.fileno(), fcntl.LOCK_SH)
+            rebuildIndex(mbox, fp)
+         finally:
+            fp.close()
+      except:
+         print "Unable to index mailbox:", mbox
+      else:
+         cnt += 1
+
+   print "SynGen: Rebuilt %d mailbox indexes" % cnt
+
+   return
+
+# Mailbox Maintenance Utilities ----------------------------------------
+
+# Mailboxes are expired by copying the messages to keep, a line at a
+# time, to a new file that is renamed over the mbox once it is on disk,
+# so a crash or a full disk partway through loses nothing.  The mbox is
+# locked just as writeMailbox() locks it, and the new file as well until
+# its index is rebuilt; writers waiting on the old one notice the rename
+# and move on to the new one.  Only the headers of one message are held
+# in memory, whatever the size of the mbox.
+
+_archiveRe = re.compile(r'\.\d+$')
+
+def messageDate(headers):
+   """
+   args: headers - header lines of a message, From_ line first
+   output: none
+   returns: seconds since the epoch from the Date header, or failing
+            that the From_ line, None if neither can be read
+   """
+
+   dates = []
+   for line in headers[1:]:
+      if string.lower(line[:5]) == 'date:':
+         dates.append(string.strip(line[5:]))
+   if headers and headers[0][:5] == 'From ':
+      dates.append(string.join(string.split(headers[0])[2:]))
+
+   for text in dates:
+      parsed = email.Utils.parsedate_tz(text)
+      if parsed is None:
+         continue
+      if parsed[9] is None:
+         return calendar.timegm(parsed[:9])    # ours are all UTC
+      return email.Utils.mktime_tz(parsed)
+
+   return None
+
+def firstMessageDate(mbox):
+   """
+   args: mbox - filename
+   output: none
+   returns: date of the first message as by messageDate(), None if the
+            mbox is empty or it has no date
+   """
+
+   fp = file(mbox, 'r')
+   headers = []
+
+   while True:
+      line = fp.readline()
+      if not line or (headers and line == '\n'):
+         break
+      if headers or line[:5] == 'From ':
+         headers.append(line)
+
+   fp.close()
+
+   return messageDate(headers)
+
+def expireMailbox(mbox, before, archive=None):
+   """
+   args: mbox - filename
+         before - messages dated before this time are removed
+         archive - ArchiveWriter the removed messages are added to first
+   output: mbox rewritten without them, index rebuilt if MBOX_INDEX
+   returns: number of messages removed / raise exception
+   """
+
+   while True:
+      fp = file(mbox, 'r+')
+      fcntl.lockf(fp.fileno(), fcntl.LOCK_EX)
+
+      # another -maintain may have replaced it while we waited
+      try:
+         current = os.stat(mbox).st_ino
+      except OSError:
+         current = None
+      if current == os.fstat(fp.fileno()).st_ino:
+         break
+
+      fcntl.lockf(fp.fileno(), fcntl.LOCK_UN)
+      fp.close()
+
+   try:
+      # the archive is complete and on disk before the mbox is replaced
+      removed = _oldMessages(fp, before, archive)
+      if removed:
+         fp.seek(0)
+         _replaceMailbox(mbox, fp, before)
+   finally:
+      fcntl.lockf(fp.fileno(), fcntl.LOCK_UN)
+      fp.close()
+
+   return removed
+
+def _replaceMailbox(mbox, fp, before):
+   """
+   args: mbox - filename
+         fp - mbox open for reading and locked, at its start
+         before - messages dated before this time are left out
+   output: mbox replaced by a copy without them, index rebuilt if
+           MBOX_INDEX
+   returns: none / raise exception
+   """
+
+   tmp, out = _tempFile(mbox, os.fstat(fp.fileno()).st_mode & 0777)
+   fcntl.lockf(out.fileno(), fcntl.LOCK_EX)
+
+   try:
+      try:
+         _copyMessages(fp, out, before)
+         out.flush()
+         os.fsync(out.fileno())
+         os.rename(tmp, mbox)
+      except:
+         os.unlink(tmp)
+         raise
+
+      if MBOX_INDEX:
+         try:
+            rebuildIndex(mbox, out)
+         except:
+            print "Unable to update mailbox index:", mbox + INDEX_SUFFIX
+   finally:
+      fcntl.lockf(out.fileno(), fcntl.LOCK_UN)
+      out.close()
+
+   return
+
+def _copyMessages(fp, out, before):
+   """
+   args: fp - mbox open for reading, at its start
+         out - file open for writing
+         before - messages dated before this time are left out
+   output: the other messages to out
+   returns: none / raise exception
+   """
+
+   keep = 1          # current message is kept
+   headers = None    # header lines of a message not yet decided on
+   blank = 1         # previous line was blank
+
+   while True:
+      line = fp.readline()
+      if not line: break
+
+      if line[:5] == 'From ' and blank:
+         if headers is not None and _keepMessage(headers, before):
+            # message without a body, decide on what there is
+            out.writelines(headers)
+         headers = [line]
+      elif headers is not None:
+         headers.append(line)
+         # a blank line ends the headers, or give up on very long ones
+         if line == '\n' or len(headers) > 1000:
+            keep = _keepMessage(headers, before)
+            if keep:
+               out.writelines(headers)
+            headers = None
+      elif keep:
+         out.write(line)
+
+      blank = (line == '\n')
+
+   if headers is not None and _keepMessage(headers, before):
+      out.writelines(headers)
+
+   return
+
+def _keepMessage(headers, before):
+   date = messageDate(headers)
+   return date is None or date >= before
+
+def _oldMessages(fp, before, archive=None):
+   """
+   args: fp - mbox open for reading, at its start
+         before - messages dated before this time are counted
+         archive - ArchiveWriter those messages are added to, which is
+                   then closed, optional
+   output: those messages to archive
+   returns: number of messages dated before / raise exception
+   """
+
+   count = 0
+   old = 0           # current message is counted
+   headers = None    # header lines of a message not yet decided on
+   blank = 1         # previous line was blank
+
+   while True:
+      line = fp.readline()
+      if not line: break
+
+      if line[:5] == 'From ' and blank:
+         if headers is not None and not _keepMessage(headers, before):
+            count += 1
+            if archive is not None:
+               archive.add(headers)
+         headers = [line]
+         old = 0
+      elif headers is not None:
+         headers.append(line)
+         # decided just as _copyMessages() decides
+         if line == '\n' or len(headers) > 1000:
+            old = not _keepMessage(headers, before)
+            if old:
+               count += 1
+               if archive is not None:
+                  archive.add(headers)
+            headers = None
+      elif old and archive is not None:
+         archive.write(line)
+
+      blank = (line == '\n')
+
+   if headers is not None and not _keepMessage(headers, before):
+      count += 1
+      if archive is not None:
+         archive.add(headers)
+
+   if archive is not None:
+      archive.close()
+
+   return count
+
+def rotateMailbox(mbox):
+   """
+   args: mbox - filename
+   output: mbox renamed to mbox.1, mbox.1 to mbox.2 and so on, keeping
+           ROTATE_KEEP; indexes go with them
+   returns: none / raise exception
+   """
+
+   fp = file(mbox, 'a')
+   fcntl.lockf(fp.fileno(), fcntl.LOCK_EX)
+
+   names = [mbox]
+   for n in range(1, ROTATE_KEEP + 1):
+      names.append(mbox + '.%d' % n)
+
+   for suffix in ('', INDEX_SUFFIX):
+      if os.path.exists(names[-1] + suffix):
+         os.unlink(names[-1] + suffix)
+      for i in range(len(names) - 1, 0, -1):
+         if os.path.exists(names[i - 1] + suffix):
+            os.rename(names[i - 1] + suffix, names[i] + suffix)
+
+   # writers waiting on the lock notice the new file and use that
+   file(mbox, 'a').close()
+
+   fcntl.lockf(fp.fileno(), fcntl.LOCK_UN)
+   fp.close()
+
+   return
+
+def maintainMailboxes(names):
+   """
+   args: names - list of mbox names in MAILDIR, all mailboxes if empty
+   output: text with counts of mailboxes rotated and messages expired
+   returns: none
+   """
+
+   if not names:
+      for path in glob.glob(MAILDIR + "/*"):
+         name = os.path.basename(path)
+         if os.path.isfile(path) and name[-len(INDEX_SUFFIX):] != \
+               INDEX_SUFFIX and not _archiveRe.search(name):
+            names.append(name)
+
+   now = time.time()
+   rotated = expired = archived = 0
+
+   for name in names:
+      mbox = MAILDIR + "/" + name
+
+      try:
+         size = os.path.getsize(mbox)
+         if ROTATE_AGE and size:
+            first = firstMessageDate(mbox)
+         else:
+            first = None
+
+         if (ROTATE_SIZE and size > ROTATE_SIZE) or \
+               (first is not None and first < now - ROTATE_AGE):
+            rotateMailbox(mbox)
+            rotated += 1
+
+         if RETENTION or ARCHIVE_AGE:
+            for n in range(ROTATE_KEEP + 1):
+               path = mbox
+               if n:
+                  path = mbox + '.%d' % n
+               if not os.path.exists(path):
+                  continue
+
+               if RETENTION:
+                  expired += expireMailbox(path, now - RETENTION)
+               if ARCHIVE_AGE:
+                  archive = ArchiveWriter(name)
+                  archived += expireMailbox(path, now - ARCHIVE_AGE, archive)
+
+               # nothing left in a rotated copy, drop it
+               if n and not os.path.getsize(path):
+                  os.unlink(path)
+                  if os.path.exists(path + INDEX_SUFFIX):
+                     os.unlink(path + INDEX_SUFFIX)
+
+         if RETENTION:
+            expired += expireArchive(name, now - RETENTION)
+      except:
+         print "Unable to maintain mailbox:", mbox
+
+   print "SynGen: Rotated %d mailboxes, expired %d messages, " \
+         "archived %d messages" % (rotated, expired, archived)
+
+   return
+
+# Mailbox Archive Utilities --------------------------------------------
+
+# A segment is a series of gzip members, each holding up to ARCHIVE_BLOCK
+# bytes of whole messages in MBOX format, so "zcat NAME.0001.gz" gives an
+# ordinary mbox.  Its index has a line per message:
+#
+#    block offset, block length, offset and length in block, date,
+#    Message-ID and Subject, separated by tabs
+#
+# Blocks are only appended, and the index only after the segment is
+# synced to disk; anything in a segment past the end of its index is
+# left over from an interrupted run and written over by the next one.
+
+_segmentRe = re.compile(r'\.(\d+)\.gz$')
+
+def archiveFiles(name, n):
+   """
+   args: name - mbox name in MAILDIR
+         n - segment number
+   output: none
+   returns: (segment, index) file names
+   """
+
+   base = ARCHIVEDIR + "/" + name + ".%04d" % n
+   return (base + ".gz", base + ".idx")
+
+def archiveSegments(name):
+   """
+   args: name - mbox name in MAILDIR
+   output: none
+   returns: sorted list of the numbers of the archive segments of name
+   """
+
+   segments = []
+
+   if os.path.isdir(ARCHIVEDIR):
+      for entry in os.listdir(ARCHIVEDIR):
+         match = _segmentRe.search(entry)
+         if match and entry[:match.start()] == name:
+            segments.append(int(match.group(1)))
+
+   segments.sort()
+
+   return segments
+
+def headerValue(lines, name):
+   """
+   args: lines - header lines of a message
+         name - header name, lower case
+   output: none
+   returns: first value of header name, RFC 2047 words decoded to utf-8
+            and folded onto one line, '' if there is none
+   """
+
+   value = None
+   prefix = name + ':'
+
+   for line in lines:
+      if value is not None:
+         if line[:1] in (' ', '\t'):
+            value = value + ' ' + string.strip(line)
+            continue
+         break
+      if string.lower(line[:len(prefix)]) == prefix:
+         value = string.strip(line[len(prefix):])
+
+   if value is None:
+      return ''
+
+   try:
+      parts = []
+      for text, charset in email.Header.decode_header(value):
+         parts.append(unicode(text, charset or 'us-ascii', 'replace'))
+      value = string.join(parts, '').encode('utf-8')
+   except:
+      pass
+
+   return string.join(string.split(value))
+
+def _archiveEnd(ifile):
+   """
+   args: ifile - file and path of segment index
+   output: none
+   returns: segment offset just past the last indexed block, 0 if the
+            index is missing or empty
+   """
+
+   try:
+      fp = file(ifile, 'r')
+   except:
+      return 0
+
+   fp.seek(0, 2)
+   size = fp.tell()
+   fp.seek(max(0, size - 8192))
+   lines = string.split(fp.read(), '\n')
+   fp.close()
+
+   if len(lines) < 2:
+      return 0
+
+   offset, length, rest = string.split(lines[-2], '\t', 2)
+
+   return int(offset) + int(length)
+
+class ArchiveWriter:
+   """
+   Appends messages in MBOX format to the newest archive segment of a
+   mailbox.  add() starts a message with its header lines, write() adds
+   the lines that follow and close() syncs the segment and its index.
+   """
+
+   def __init__(self, name):
+      self.name = name
+      self.fp = None        # segment, opened with the first block
+      self.ifile = None
+      self.pending = []     # index lines of blocks not yet synced
+      self.block = []       # messages of the block being filled
+      self.entries = []     # (offset, length, lines) of each
+      self.size = 0
+      self.lines = None     # lines of the message being added
+
+   def add(self, headers):
+      self._endMessage()
+      self.lines = list(headers)
+
+   def write(self, line):
+      self.lines.append(line)
+
+   def close(self):
+      self._endMessage()
+      self._endBlock()
+      self._endSegment()
+
+   def _endMessage(self):
+      if self.lines is None:
+         return
+
+      text = string.join(self.lines, '')
+      self.entries.append((self.size, len(text), self.lines[:50]))
+      self.block.append(text)
+      self.size += len(text)
+      self.lines = None
+
+      if self.size >= ARCHIVE_BLOCK:
+         self._endBlock()
+
+   def _endBlock(self):
+      if not self.block:
+         return
+
+      if self.fp is None:
+         self._openSegment()
+
+      comp = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+      data = comp.compress(string.join(self.block, '')) + comp.flush()
+
+      offset = self.fp.tell()
+      self.fp.write(data)
+
+      for pos, length, lines in self.entries:
+         date = messageDate(lines) or 0
+         self.pending.append('%d\t%d\t%d\t%d\t%d\t%s\t%s\n' % (offset,
+            len(data), pos, length, date, string.replace(messageId(lines),
+            '\t', ' '), headerValue(lines, 'subject')))
+
+      self.block = []
+      self.entries = []
+      self.size = 0
+
+      if self.fp.tell() >= ARCHIVE_SEGMENT:
+         self._endSegment()
+
+   def _openSegment(self):
+      if not os.path.isdir(ARCHIVEDIR):
+         os.makedirs(ARCHIVEDIR, 0700)
+
+      segments = archiveSegments(self.name)
+      if segments:
+         n = segments[-1]
+      else:
+         n = 1
+
+      segment, ifile = archiveFiles(self.name, n)
+      end = _archiveEnd(ifile)
+      if end >= ARCHIVE_SEGMENT:
+         segment, ifile = archiveFiles(self.name, n + 1)
+         end = 0
+
+      if not os.path.exists(segment):
+         file(segment, 'w').close()
+
+      self.fp = file(segment, 'r+')
+      self.fp.truncate(end)
+      self.fp.seek(end)
+      self.ifile = ifile
+
+   def _endSegment(self):
+      if self.fp is None:
+         return
+
+      self.fp.flush()
+      os.fsync(self.fp.fileno())
+      self.fp.close()
+      self.fp = None
+
+      fp = file(self.ifile, 'a')
+      fp.write(string.join(self.pending, ''))
+      fp.flush()
+      os.fsync(fp.fileno())
+      fp.close()
+      self.pending = []
+
+def readArchiveIndex(name, n):
+   """
+   args: name - mbox name in MAILDIR
+         n - segment number
+   output: none
+   returns: list of (block offset, block length, offset, length, date,
+            msgid, subject) of the messages in the segment
+   """
+
+   entries = []
+
+   fp = file(archiveFiles(name, n)[1], 'r')
+   for line in fp.readlines():
+      fields = string.split(string.rstrip(line, '\n'), '\t', 6)
+      for i in range(5):
+         fields[i] = int(fields[i])
+      entries.append(tuple(fields))
+   fp.close()
+
+   return entries
+
+def expireArchive(name, before):
+   """
+   args: name - mbox name in MAILDIR
+         before - segments holding only messages dated before this time
+                  are removed
+   output: those segments and their indexes removed
+   returns: number of messages removed / raise exception
+   """
+
+   removed = 0
+
+   for n in archiveSegments(name):
+      entries = readArchiveIndex(name, n)
+      newest = 0
+      for entry in entries:
+         newest = max(newest, entry[4])
+
+      if newest < before:
+         for path in archiveFiles(name, n):
+            if os.path.exists(path):
+               os.unlink(path)
+         removed += len(entries)
+
+   return removed
+
+def searchArchive(name, text):
+   """
+   args: name - mbox name in MAILDIR
+         text - looked for in Message-ID and Subject, any case; '' for all
+   output: date, Message-ID and Subject of the archived messages found
+   returns: none
+   """
+
+   text = string.lower(text)
+
+   for n in archiveSegments(name):
+      for entry in readArchiveIndex(name, n):
+         msgid, subject = entry[5:]
+         if string.find(string.lower(msgid), text) == -1 and \
+               string.find(string.lower(subject), text) == -1:
+            continue
+         date = time.strftime('%Y-%m-%d %H:%M', time.gmtime(entry[4]))
+         print "%s  %s  %s" % (date, msgid, subject)
+
+   return
+
+def extractArchive(name, msgids):
+   """
+   args: name - mbox name in MAILDIR
+         msgids - Message-IDs of the messages wanted, all if empty
+   output: those messages in MBOX format
+   returns: number of messages written / raise exception
+   """
+
+   wanted = sets.Set(msgids)
+   cnt = 0
+
+   for n in archiveSegments(name):
+      fp = None
+      block = None      # (offset, text) of the last block read
+
+      for offset, length, pos, size, date, msgid, subject in \
+            readArchiveIndex(name, n):
+         if wanted and msgid not in wanted:
+            continue
+
+         if block is None or block[0] != offset:
+            if fp is None:
+               fp = file(archiveFiles(name, n)[0], 'r')
+            fp.seek(offset)
+            decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            block = (offset, decomp.decompress(fp.read(length)))
+
+         sys.stdout.write(block[1][pos:pos + size])
+         cnt += 1
+
+      if fp is not None:
+         fp.close()
+
+   return cnt
+
+# State Storage Utilities ----------------------------------------------
+
+# Feed state is addressed by its file name under VAR, whichever backend
+# holds it.  The dbm backend keys records by the same relative path.
+# Changes to it are held in memory until syncState(), as are changes to
+# files once keepStateInMemory() has been called, which also keeps
+# everything read in memory.
+
+_stateDb = None
+_stateDirty = {}     # key -> new value, None to delete
+_stateCache = None   # key -> value, when state is kept in memory
+_stateLock = threading.Lock()
+
+def _stateKey(path):
+   return path[len(VAR) + 1:]
+
+def _writeBack():
+   return STATE_BACKEND == 'dbm' or _stateCache is not None
+
+def _stateFiles(dir):
+   # records of the files backend, without ones left half written
+   return [ path for path in glob.glob(dir + "/*") if path[-4:] != '.new' ]
+
+def _openStateDb():
+   """
+   args: none
+   output: none
+   returns: open state database, migrated from the files layout on first
+            use / raise exception
+   """
+
+   global _stateDb
+
+   if _stateDb is None:
+      db = anydbm.open(STATEDB, 'c')
+
+      if not db.has_key('syngen/version'):
+         for subdir in (MODIFIED, CACHE):
+            for path in _stateFiles(subdir):
+               try:
+                  fp = file(path, 'r')
+                  db[_stateKey(path)] = fp.read()
+                  fp.close()
+               except:
+                  print "Unable to migrate state file:", path
+         db['syngen/version'] = __version__
+
+      _stateDb = db
+
+   return _stateDb
+
+def _readStored(key):
+   if STATE_BACKEND == 'dbm':
+      db = _openStateDb()
+      if db.has_key(key):
+         return db[key]
+      return None
+
+   try:
+      fp = file(VAR + "/" + key, 'r')
+   except:
+      data = None
+   else:
+      data = fp.read()
+      fp.close()
+
+   return data
+
+def _writeStored(key, data):
+   if STATE_BACKEND == 'dbm':
+      db = _openStateDb()
+      if data is not None:
+         db[key] = data
+      elif db.has_key(key):
+         del db[key]
+      return
+
+   path = VAR + "/" + key
+
+   if data is None:
+      if os.path.exists(path):
+         os.unlink(path)
+      return
+
+   # write aside and rename so the record is never seen half written
+   tmp = path + '.new'
+   fp = file(tmp, 'w')
+   fp.write(data)
+   fp.close()
+   os.rename(tmp, path)
+
+def keepStateInMemory():
+   """
+   args: none
+   output: none
+   returns: none
+
+   From now on state read is kept in memory and changes are only
+   written by syncState().
+   """
+
+   global _stateCache
+
+   if _stateCache is None:
+      _stateCache = {}
+
+   return
+
+def readState(path):
+   """
+   args: path - file and path of state record
+   output: none
+   returns: stored string, None if there is none
+   """
+
+   if not path:
+      return None
+
+   key = _stateKey(path)
+
+   _stateLock.acquire()
+   try:
+      if _stateDirty.has_key(key):
+         data = _stateDirty[key]
+      elif _stateCache is not None and _stateCache.has_key(key):
+         data = _stateCache[key]
+      else:
+         data = _readStored(key)
+         if _stateCache is not None:
+            _stateCache[key] = data
+   finally:
+      _stateLock.release()
+
+   return data
+
+def writeState(path, data):
+   """
+   args: path - file and path of state record
+         data - string to store
+   output: none
+   returns: none / raise exception
+   """
+
+   key = _stateKey(path)
+
+   # feedparser hands back unicode; records are stored as utf-8
+   if type(data) == type(u''):
+      data = data.encode('utf-8')
+
+   if _writeBack():
+      _stateLock.acquire()
+      try:
+         _stateDirty[key] = data
+      finally:
+         _stateLock.release()
+   else:
+      _writeStored(key, data)
+
+   return
+
+def removeState(path):
+   """
+   args: path - file and path of state record
+   output: none
+   returns: none / raise exception if there is no such record
+   """
+
+   if _writeBack():
+      if readState(path) is None:
+         raise KeyError(path)
+
+      _stateLock.acquire()
+      try:
+         _stateDirty[_stateKey(path)] = None
+      finally:
+         _stateLock.release()
+   else:
+      os.unlink(path)
+
+   return
+
+def listState(dir):
+   """
+   args: dir - MODIFIED or CACHE
+   output: none
+   returns: list of record names (feed hashes) stored under dir
+   """
+
+   prefix = _stateKey(dir) + '/'
+
+   _stateLock.acquire()
+   try:
+      names = {}
+
+      if STATE_BACKEND == 'dbm':
+         for key in _openStateDb().keys():
+            if key[:len(prefix)] == prefix:
+               names[key[len(prefix):]] = 1
+      else:
+         for path in _stateFiles(dir):
+            names[os.path.basename(path)] = 1
+
+      for key, data in _stateDirty.items():
+         if key[:len(prefix)] == prefix:
+            if data is None:
+               if names.has_key(key[len(prefix):]):
+                  del names[key[len(prefix):]]
+            else:
+               names[key[len(prefix):]] = 1
+   finally:
+      _stateLock.release()
+
+   return names.keys()
+
+def syncState():
+   """
+   args: none
+   output: none
+   returns: none / raise exception
+
+   Writes all pending changes in one batch.
+   """
+
+   if _NOUPDATE: return
+
+   _stateLock.acquire()
+   try:
+      if _stateDirty:
+         for key, data in _stateDirty.items():
+            _writeStored(key, data)
+            if _stateCache is not None:
+               _stateCache[key] = data
+         _stateDirty.clear()
+
+         if STATE_BACKEND == 'dbm':
+            db = _openStateDb()
+            if hasattr(db, 'sync'): db.sync()
+   finally:
+      _stateLock.release()
+
+   return
+
+def closeState():
+   """
+   args: none
+   output: none
+   returns: none / raise exception
+   """
+
+   global _stateDb
+
+   syncState()
+
+   if _stateDb is not None:
+      _stateDb.close()
+      _stateDb = None
+
+   return
+
+# Article Cache Utilities ----------------------------------------------
+
+def loadArticleIds(cfile):
+   """
+   args: cfile - file and path of cache file
+   output: none
+   returns: list of article ids, oldest first, empty if no cache file
+   """
+
+   data = readState(cfile)
+
+   # a ring has only digests of the ids, see SeenRing
+   if data is None or data[:len(SeenRing.MAGIC)] == SeenRing.MAGIC:
+      ids = []
+   else:
+      ids = string.split(data) # string to list
+
+   return ids
+
+def saveArticleIds(cfile, ids):
+   """
+   args: cfile - file and path of cache file
+         ids - list of article ids, oldest first
+   output: error string
+   returns: none
+   """
+
+   if _NOUPDATE: return
+
+   out = string.join(ids, '\n') + '\n'
+
+   try:
+      writeState(cfile, out)
+   except:
+      print "Error saving article ids in file:", cfile
+
+   return
+
+class ArticleCache:
+   """
+   The previously seen article ids of one feed.  The cache file is read
+   once into a set, checked in memory and written back by save().  Given
+   ids instead, and no cfile, it works on those and saves nothing.
+   """
+
+   def __init__(self, cfile, ids = None):
+      self.cfile = cfile
+      if ids is None:
+         ids = loadArticleIds(cfile)
+      self.ids = ids
+      self.seen = sets.Set(self.ids)
+      self.added = []         # new ids, in the order they were seen
+      self.changed = 0
+
+   def checkDupe(self, guid, add = 1):
+      """
+      args: guid - uniq hash of item data
+            add - add guid to the cache if it is not a dupe
+      output: none
+      returns: 1 - dupe, 0 - not dupe
+      """
+
+      if guid in self.seen:
+         return 1
+
+      if not add:
+         return 0
+
+      if len(self.ids) > MAX_CACHE_ENTRIES:
+         goners = len(self.ids) - MIN_CACHE_ENTRIES
+         del self.ids[0:goners]
+         self.seen = sets.Set(self.ids)
+
+      self.ids.append(guid)
+      self.seen.add(guid)
+      self.added.append(guid)
+      self.changed = 1
+
+      return 0
+
+   def save(self):
+      """
+      args: none
+      output: error string
+      returns: none
+      """
+
+      if self.changed and self.cfile:
+         saveArticleIds(self.cfile, self.ids)
+         self.changed = 0
+
+      return
+
+class SeenRing:
+   """
+   The previously seen article ids of one feed as a ring of 16 byte md5
+   digests after a header of capacity, count and next slot.  The file is
+   mapped into memory and save() writes new digests over the oldest in
+   place; lookups use find() on a copy taken when it was opened, which
+   is much faster than on the map.  Given the file's contents instead,
+   and no cfile, it works on those and saves nothing.
+   """
+
+   MAGIC = 'SYNRING1'
+   HEADER = 32
+
+   def __init__(self, cfile, data = None):
+      self.cfile = cfile
+      self.added = []         # new ids, in the order they were seen
+      self.recent = sets.Set()  # their digests
+      self.pending = []       # digests not written to the ring yet
+      self.fp = None
+
+      if data is None and not _NOUPDATE:
+         if not os.path.exists(cfile):
+            self._write([])
+         self._open()
+         return
+
+      if data is None:
+         data = ''
+         if os.path.exists(cfile):
+            data = file(cfile, 'r').read()
+         if data[:len(self.MAGIC)] != self.MAGIC:
+            data = self._ringData(self._digests(data)[-HISTORY_ENTRIES:])
+      self.map = self.data = data
+      self.cfile = None
+
+   def _open(self):
+      size = self.HEADER + HISTORY_ENTRIES * 16
+
+      fp = file(self.cfile, 'r+')
+      head = fp.read(self.HEADER)
+      if head[:len(self.MAGIC)] != self.MAGIC or \
+            struct.unpack('>I', head[8:12])[0] != HISTORY_ENTRIES:
+         # a text cache, or a ring of another size
+         fp.seek(0)
+         digests = self._digests(fp.read())[-HISTORY_ENTRIES:]
+         fp.close()
+         self._write(digests)
+         fp = file(self.cfile, 'r+')
+
+      self.fp = fp
+      self.map = mmap.mmap(fp.fileno(), size)
+      self.data = self.map[:]
+
+   def _digests(self, data):
+      """
+      args: data - contents of a ring or text cache
+      output: none
+      returns: list of digests in it, oldest first
+      """
+
+      if data[:len(self.MAGIC)] != self.MAGIC:
+         digests = []
+         for guid in string.split(data):
+            digests.append(md5.new(guid).digest())
+         return digests
+
+      size, count, next = struct.unpack('>III', data[8:20])
+      slots = []
+      for i in range(count):
+         slots.append(self.HEADER + 16 * ((next - count + i) % size))
+
+      digests = []
+      for pos in slots:
+         digests.append(data[pos:pos + 16])
+
+      return digests
+
+   def _ringData(self, digests):
+      count = len(digests)
+      data = [ self.MAGIC + struct.pack('>III', HISTORY_ENTRIES, count,
+               count % HISTORY_ENTRIES), '\0' * (self.HEADER - 20) ]
+      data.extend(digests)
+      data.append('\0' * (16 * (HISTORY_ENTRIES - count)))
+      return string.join(data, '')
+
+   def _write(self, digests):
+      tmp = self.cfile + '.new'
+      fp = file(tmp, 'w')
+      fp.write(self._ringData(digests))
+      fp.close()
+      os.rename(tmp, self.cfile)
+
+   def _find(self, digest):
+      # slots past count were never written, skip them
+      count = struct.unpack('>I', self.data[12:16])[0]
+      end = self.HEADER + 16 * count
+
+      pos = self.data.find(digest, self.HEADER, end)
+      while pos != -1:
+         if (pos - self.HEADER) % 16 == 0:
+            return 1
+         pos = self.data.find(digest, pos + 1, end)
+      return 0
+
+   def checkDupe(self, guid, add = 1):
+      """
+      args: guid - uniq hash of item data
+            add - add guid to the ring if it is not a dupe
+      output: none
+      returns: 1 - dupe, 0 - not dupe
+      """
+
+      if isinstance(guid, unicode):
+         digest = md5.new(guid.encode('utf-8')).digest()
+      else:
+         digest = md5.new(guid).digest()
+
+      if digest in self.recent or self._find(digest):
+         return 1
+
+      if not add:
+         return 0
+
+      self.added.append(guid)
+      self.recent.add(digest)
+      self.pending.append(digest)
+
+      return 0
+
+   def save(self):
+      """
+      args: none
+      output: none
+      returns: none
+      """
+
+      if self.pending and self.cfile:
+         if self.fp is None:
+            self._open()       # saved before, more were seen since
+
+         size, count, next = struct.unpack('>III', self.map[8:20])
+         for digest in self.pending:
+            pos = self.HEADER + 16 * next
+            self.map[pos:pos + 16] = digest
+            next = (next + 1) % size
+            count = min(count + 1, size)
+         self.map[8:20] = struct.pack('>III', size, count, next)
+         self.pending = []
+
+      if self.fp is not None:
+         self.map.close()
+         self.fp.close()
+         self.fp = None
+
+      return
+
+def articleCache(cfile, history = None):
+   """
+   args: cfile - file and path of cache file
+         history - from loadHistory(), to use instead of cfile
+   output: none
+   returns: ArticleCache or SeenRing, as by HISTORY_FORMAT
+   """
+
+   if HISTORY_FORMAT == 'ring':
+      return SeenRing(cfile, history)
+
+   return ArticleCache(cfile, history)
+
+def loadHistory(cfile):
+   """
+   args: cfile - file and path of cache file
+   output: none
+   returns: the feed's seen articles as articleCache() takes them, for
+            checking them elsewhere
+   """
+
+   if HISTORY_FORMAT != 'ring':
+      return loadArticleIds(cfile)
+
+   ring = SeenRing(cfile)
+   data = ring.data
+   ring.save()
+
+   return data
+
+def checkDupe(cfile, guid):
+   """
+   args: cfile - file and path of cache file
+         guid - uniq hash of item data
+   output: none
+   returns: 1 - dupe, 0 - not dupe
+   """
+
+   cache = articleCache(cfile)
+   dupe = cache.checkDupe(guid)
+   cache.save()
+
+   return dupe
+
+# Global Dedupe Utilities ----------------------------------------------
+
+# The filter file is mapped into memory and shared by every thread and
+# process of SynGen, each holding a lock on it while it checks and adds
+# the keys of an article.  Keys still being seen are added to the newer
+# filter again, so a re-syndicated article is remembered as long as some
+# feed carries it.
+
+_dedupe = None
+_dedupeLock = threading.Lock()
+_trackingParamRe = re.compile(r'^(utm_[a-z]+|fbclid|gclid)=', re.I)
+
+def canonicalLink(link):
+   """
+   args: link - article url
+   output: none
+   returns: link without scheme, default port, fragment, tracking
+            parameters and trailing slash, host in lower case
+   """
+
+   scheme, netloc, path, query, fragment = urlparse.urlsplit(string.strip(link))
+   scheme = string.lower(scheme)
+   netloc = string.lower(netloc)
+
+   if (scheme, netloc[-3:]) == ('http', ':80') or \
+         (scheme, netloc[-4:]) == ('https', ':443'):
+      netloc = netloc[:string.rfind(netloc, ':')]
+   if netloc[:4] == 'www.':
+      netloc = netloc[4:]
+
+   params = []
+   for param in string.split(query, '&'):
+      if param and not _trackingParamRe.match(param):
+         params.append(param)
+
+   link = netloc + string.rstrip(path, '/')
+   if params:
+      link = link + '?' + string.join(params, '&')
+
+   return link
+
+def _dedupeWords(html):
+   text = stripHtmlTags(html)
+   if isinstance(text, unicode):
+      text = text.encode('utf-8')
+   return string.split(string.lower(text))
+
+def dedupeKeys(title, desc, link, clink):
+   """
+   args: title - article title, html, may be empty
+         desc - article text, html
+         link - article link, None if it has none
+         clink - link of the feed
+   output: none
+   returns: list of keys the article is known by, may be empty
+   """
+
+   keys = []
+
+   # the text alone is often boilerplate shared by every item of a feed,
+   # episode notes or a "read more" teaser; copies keep the title too
+   heading = _dedupeWords(title or '')
+   words = _dedupeWords(desc)
+   if heading and len(words) >= DEDUPE_MIN_WORDS:
+      keys.append('text:' + md5.new(string.join(heading) + '\n' +
+                                    string.join(words)).hexdigest())
+
+   # items without a link of their own often point at the site
+   if link and link != clink:
+      keys.append('link:' + canonicalLink(link))
+
+   return keys
+
+class DedupeFilter:
+   """
+   Two generations of a Bloom filter in a file, after a header holding
+   their size, which one is current and how many keys it has.
+   """
+
+   MAGIC = 'SYNDEDUP'
+   HEADER = 64
+
+   def __init__(self, path, size, items):
+      self.size = size
+      self.items = items
+      self.bits = size * 8
+      self.hashes = max(1, int(float(self.bits) / items * 0.693 + 0.5))
+
+      self.fp = file(path, 'a+')
+      fcntl.lockf(self.fp.fileno(), fcntl.LOCK_EX)
+      try:
+         self.fp.seek(0)
+         head = self.fp.read(len(self.MAGIC) + 4)
+         if head != self.MAGIC + struct.pack('>I', size):
+            # new, damaged or of another size, start over
+            self.fp.truncate(0)
+            self.fp.write(self.MAGIC + struct.pack('>III', size, 0, 0))
+            self.fp.truncate(self.HEADER + 2 * size)
+            self.fp.flush()
+         self.map = mmap.mmap(self.fp.fileno(), self.HEADER + 2 * size)
+      finally:
+         fcntl.lockf(self.fp.fileno(), fcntl.LOCK_UN)
+
+   def _positions(self, key):
+      h1, h2 = struct.unpack('>QQ', md5.new(key).digest())
+      h2 = h2 | 1
+      positions = []
+      for i in range(self.hashes):
+         pos = (h1 + i * h2) % self.bits
+         positions.append((pos >> 3, 1 << (pos & 7)))
+      return positions
+
+   def _test(self, gen, positions):
+      base = self.HEADER + gen * self.size
+      for offset, bit in positions:
+         if not ord(self.map[base + offset]) & bit:
+            return 0
+      return 1
+
+   def _set(self, gen, positions):
+      base = self.HEADER + gen * self.size
+      for offset, bit in positions:
+         self.map[base + offset] = chr(ord(self.map[base + offset]) | bit)
+
+   def seen(self, keys, update = 1):
+      """
+      args: keys - keys of one article
+            update - add the keys
+      output: none
+      returns: 1 - one of the keys was seen before, 0 - none were
+      """
+
+      pos = len(self.MAGIC) + 4
+      found = 0
+
+      fcntl.lockf(self.fp.fileno(), fcntl.LOCK_EX)
+      try:
+         current, count = struct.unpack('>II', self.map[pos:pos + 8])
+
+         for key in keys:
+            positions = self._positions(key)
+            if self._test(current, positions):
+               found = 1
+               continue
+            if self._test(1 - current, positions):
+               found = 1
+            if update:
+               self._set(current, positions)
+               count += 1
+
+         if count >= self.items:
+            current = 1 - current
+            count = 0
+            start = self.HEADER + current * self.size
+            self.map[start:start + self.size] = '\0' * self.size
+
+         self.map[pos:pos + 8] = struct.pack('>II', current, count)
+      finally:
+         fcntl.lockf(self.fp.fileno(), fcntl.LOCK_UN)
+
+      return found
+
+   def close(self):
+      self.map.flush()
+      self.map.close()
+      self.fp.close()
+
+def seenElsewhere(keys):
+   """
+   args: keys - from dedupeKeys()
+   output: error string
+   returns: 1 - the article was seen before, in any feed; 0 - not seen,
+            its keys are added
+   """
+
+   global _dedupe
+
+   if not keys:
+      return 0
+
+   _dedupeLock.acquire()
+   try:
+      try:
+         if _dedupe is None:
+            _dedupe = DedupeFilter(DEDUPE_FILE, DEDUPE_SIZE, DEDUPE_ITEMS)
+         return _dedupe.seen(keys, not _NOUPDATE)
+      except:
+         print "Error checking dedupe file:", DEDUPE_FILE
+         return 0
+   finally:
+      _dedupeLock.release()
+
+def closeDedupe():
+   """
+   args: none
+   output: dedupe file synced to disk
+   returns: none
+   """
+
+   global _dedupe
+
+   if _dedupe is not None:
+      _dedupe.close()
+      _dedupe = None
+
+   return
+
+# Feed Cache Utilities -------------------------------------------------
+
+def readMfile(mfile):
+   """
+   args: mfile - file and path to last modified data
+   output: none
+   returns: data dictionary with 'etag' and 'modified' values always set
+   """
+
+   data = { 'etag': None, 'modified': None }
+
+   pickled = readState(mfile)
+
+   if pickled is not None:
+      try:
+         cuke = cPickle.loads(pickled)
+      except:
+         pass
+      else:
+         data = cuke
+         
+   return data
+
+# polling schedule, watermark, body digest and failure values, kept
+# alongside etag and modified
+_mfileKeys = ('interval', 'due', 'checked', 'updated', 'watermark',
+              'unsorted', 'digest', 'failures', 'failing', 'retry',
+              'failed')
+
+def writeMfile(mfile, data):
+   """
+   args: mfile - file and path to last modified data
+         data - feedparser data dictionary or readMfile() result
+   output: none
+   returns: 0 - Success, 1 - Fail
+   """
+
+   if _NOUPDATE: return 0
+
+   data.setdefault('etag', None)
+   data.setdefault('modified', None)
+
+   output = {}
+   output['etag'] = data['etag']
+   output['modified'] = data['modified']
+
+   for key in _mfileKeys:
+      if data.has_key(key):
+         output[key] = data[key]
+
+   try:
+      writeState(mfile, cPickle.dumps(output))
+   except:
+      rc = 1
+   else:
+      rc = 0
+
+   return rc
+
+# Polling Schedule Utilities -------------------------------------------
+
+def feedDue(mdata, now):
+   """
+   args: mdata - readMfile() data dictionary
+         now - current time, seconds since the epoch
+   output: none
+   returns: true if the feed should be fetched this run
+   """
+
+   return mdata.get('due', 0) <= now + POLL_SLACK
+
+def scheduleFeed(mdata, now, status, new, times):
+   """
+   args: mdata - readMfile() data dictionary, updated in place
+         now - current time, seconds since the epoch
+         status - HTTP status of the fetch, None if unknown
+         new - number of new articles found
+         times - publication times of the new articles, if known
+   output: none
+   returns: none
+
+   The interval moves half way towards the gap observed between new
+   articles and grows by POLL_BACKOFF while nothing new turns up.
+   """
+
+   interval = mdata.get('interval', MIN_POLL_INTERVAL)
+
+   if new:
+      gaps = []
+      if len(times) > 1:
+         gaps.append((max(times) - min(times)) / float(len(times) - 1))
+      if mdata.get('updated'):
+         gaps.append((now - mdata['updated']) / float(new))
+      if gaps:
+         interval = (interval + min(gaps)) / 2.0
+      mdata['updated'] = now
+   elif status is None or status < 400:
+      interval = interval * POLL_BACKOFF
+
+   interval = max(MIN_POLL_INTERVAL, min(MAX_POLL_INTERVAL, interval))
+   jitter = random.uniform(-POLL_JITTER, POLL_JITTER) * interval
+
+   mdata['interval'] = interval
+   mdata['checked'] = now
+   mdata['due'] = now + interval + jitter
+
+   return
+
+# Feed Failure Utilities -----------------------------------------------
+
+# A failing feed keeps the number of 'failures' in a row, the time it
+# has been 'failing' since, the time before which it is not fetched
+# again ('retry') and the kind of error last reported ('failed') with
+# its mfile data.  Failing hosts are only known to this process.
+
+class FeedError(Exception):
+   """
+   A feed that was fetched but can not be used, with the detail that is
+   reported and the HTTP status, if that was the problem.
+   """
+
+   def __init__(self, detail, status = None):
+      Exception.__init__(self, detail)
+      self.status = status
+
+_hostFailures = {}     # host -> [fetches failed in a row, skipped until]
+_hostLock = threading.Lock()
+
+def hostSkipped(host, now):
+   """
+   args: host - feedHost() of a feed
+         now - current time, seconds since the epoch
+   output: none
+   returns: true if the host's feeds are not to be fetched now
+   """
+
+   if not host or not HOST_FAILURES:
+      return 0
+
+   _hostLock.acquire()
+   try:
+      record = _hostFailures.get(host)
+      if record is None or record[0] < HOST_FAILURES:
+         return 0
+      if record[1] > now:
+         return 1
+
+      # one feed goes through to try the host again
+      record[1] = now + HOST_RETRY
+      return 0
+   finally:
+      _hostLock.release()
+
+def hostFailed(host, now):
+   """
+   args: host - feedHost() of a feed whose fetch failed
+         now - current time, seconds since the epoch
+   output: none
+   returns: none
+   """
+
+   _hostLock.acquire()
+   try:
+      record = _hostFailures.setdefault(host, [0, 0])
+      record[0] += 1
+      if record[0] >= HOST_FAILURES:
+         record[1] = now + HOST_RETRY
+   finally:
+      _hostLock.release()
+
+def hostWorked(host):
+   """
+   args: host - feedHost() of a feed fetched without trouble
+   output: none
+   returns: none
+   """
+
+   _hostLock.acquire()
+   try:
+      if _hostFailures.has_key(host):
+         del _hostFailures[host]
+   finally:
+      _hostLock.release()
+
+def hostFailure(error):
+   """
+   args: error - exception a feed failed with
+   output: none
+   returns: true if it says the feed's host is down rather than the feed
+   """
+
+   if isinstance(error, FeedError):
+      return error.status is not None and error.status >= 500
+
+   return isinstance(error, (socket.error, httplib.HTTPException,
+                             urllib2.URLError))
+
+def feedFailed(url, mdata, detail, now):
+   """
+   args: url - RSS url
+         mdata - readMfile() data dictionary, updated in place
+         detail - detail string of the error
+         now - current time, seconds since the epoch
+   output: none
+   returns: error message in MBOX format, empty if this kind of error
+            was reported already
+   """
+
+   failures = mdata.get('failures', 0) + 1
+   if failures == 1:
+      mdata['failing'] = now
+
+   mdata['failures'] = failures
+   mdata['retry'] = now + min(FAIL_BACKOFF * 2 ** (failures - 1),
+                              FAIL_BACKOFF_MAX)
+
+   # the exception and its arguments, not where it was raised
+   kind = string.split(detail, '[', 1)[0]
+   if mdata.get('failed') == kind:
+      return ""
+   mdata['failed'] = kind
+
+   note = 'Failed ' + str(failures) + ' time(s) in a row, since ' + \
+          time.asctime(time.gmtime(mdata['failing'])) + '.\n'
+   if FAIL_BACKOFF:
+      note = note + 'Not fetched again before ' + \
+             time.asctime(time.gmtime(mdata['retry'])) + '.\n'
+   note = note + 'The same error is not reported again.\n'
+
+   return formatFeedError(detail, url, note)
+
+def feedRecovered(url, mdata, now):
+   """
+   args: url - RSS url
+         mdata - readMfile() data dictionary, updated in place
+         now - current time, seconds since the epoch
+   output: none
+   returns: message in MBOX format that the feed works again, empty if
+            it was not failing
+   """
+
+   failures = mdata.get('failures', 0)
+   if not failures:
+      return ""
+
+   since = mdata.get('failing', now)
+   for key in ('failures', 'failing', 'retry', 'failed'):
+      if mdata.has_key(key):
+         del mdata[key]
+
+   return formatFeedRecovered(url, failures, since)
+
+# Cache File Utilities -------------------------------------------------
+
+def cacheCleanup():
+   """
+   args: none
+   output: text with count of files removed
+   returns: none / raise exception
+   """
+
+   if BLOGLINES: return
+
+   cnt = 0
+
+   try:
+      data = getFeedInfo()
+   except:
+      print "Unable to open FEEDFILE", FEEDFILE
+      sys.exit(1)
+   else:
+      # the state of feeds in other shards goes too, other hosts keep it
+      current = []
+      for line in string.split(data):
+         url, hash, mfile = string.split(line, '|')
+         if inShard(hash):
+            current.append(hash)
+      
+      exists = listState(CACHE)
+
+      curSet = sets.Set(current)
+      existsSet = sets.Set(exists)
+      extraSet = existsSet.difference(curSet)
+
+      cnt = len(extraSet)
+
+      for hash in extraSet:
+         cfile = CACHE + "/" + hash
+         mfile = MODIFIED + "/" + hash
+         try:
+            removeState(cfile)
+            removeState(mfile)
+         except:
+            print "Unable to remove file:", hash
+         else:
+            continue
+
+      syncState()
+
+      print "SynGen: Removed %d cache files" % cnt
+
+   return
+
+# Metrics Utilities ----------------------------------------------------
+
+# Every feed processed gets a dictionary of its metrics, filled in as it
+# goes through fetch, parse, render and write.  At the end of each run
+# they are written out, with totals for the run, when METRICS is set.
+
+_feedMetrics = []
+_metricKeys = ('bytes', 'fetch', 'parse', 'render', 'write', 'total',
+               'entries', 'new', 'dupes', 'shared', 'skipped', 'unchanged',
+               'deferred')
+
+def feedStats(url, mbox):
+   """
+   args: url - RSS url or Bloglines subid
+         mbox - name of mailbox
+   output: none
+   returns: empty metrics dictionary for the feed, part of this run's
+   """
+
+   stats = { 'url': url, 'mbox': os.path.basename(mbox), 'status': None,
+             'error': 0 }
+   _feedMetrics.append(stats)
+
+   return stats
+
+def jsonValue(value):
+   """
+   args: value - None, number, string, list or dictionary of those
+   output: none
+   returns: value in JSON notation
+   """
+
+   if value is None:
+      return 'null'
+   elif isinstance(value, bool):
+      return str(value).lower()
+   elif isinstance(value, (int, long)):
+      return str(value)
+   elif isinstance(value, float):
+      return '%.6f' % value
+   elif isinstance(value, (list, tuple)):
+      return '[' + string.join(map(jsonValue, value), ', ') + ']'
+   elif isinstance(value, dict):
+      keys = value.keys()
+      keys.sort()
+      items = [ jsonValue(key) + ': ' + jsonValue(value[key])
+                for key in keys ]
+      return '{' + string.join(items, ', ') + '}'
+
+   if not isinstance(value, unicode):
+      value = unicode(str(value), 'utf-8', 'replace')
+
+   out = []
+   for char in value:
+      if char in '"\\':
+         out.append('\\' + char)
+      elif ord(char) > 0xffff:
+         code = ord(char) - 0x10000
+         out.append('\\u%04x\\u%04x' % (0xd800 + (code >> 10),
+                                        0xdc00 + (code & 0x3ff)))
+      elif char < u' ' or char > u'~':
+         out.append('\\u%04x' % ord(char))
+      else:
+         out.append(str(char))
+
+   return '"' + string.join(out, '') + '"'
+
+def _promLabel(value):
+   if isinstance(value, unicode):
+      value = value.encode('utf-8')
+   value = string.replace(value, '\\', '\\\\')
+   value = string.replace(value, '"', '\\"')
+   return string.replace(value, '\n', '\\n')
+
+# name, help text and metrics key of each per feed Prometheus gauge
+_promFeed = [
+   ('status', 'HTTP status of the last fetch, 0 if none', 'status'),
+   ('not_modified', '1 if the feed was unchanged (HTTP 304)',
+    'not_modified'),
+   ('bytes', 'Bytes of feed data received', 'bytes'),
+   ('fetch_seconds', 'Time spent fetching the feed', 'fetch'),
+   ('parse_seconds', 'Time spent parsing the feed', 'parse'),
+   ('render_seconds', 'Time spent rendering new articles', 'render'),
+   ('write_seconds', 'Time spent writing to the mbox', 'write'),
+   ('seconds', 'Total time spent on the feed', 'total'),
+   ('entries', 'Articles in the feed', 'entries'),
+   ('new_entries', 'New articles written', 'new'),
+   ('dupes', 'Articles seen before', 'dupes'),
+   ('shared_dupes', 'Articles seen before in another feed', 'shared'),
+   ('skipped', 'Older articles not looked at, after EARLY_STOP', 'skipped'),
+   ('unchanged', '1 if the same feed was sent again, not parsed',
+    'unchanged'),
+   ('deferred', '1 if the feed or its host was failing, not fetched',
+    'deferred'),
+   ('error', '1 if processing the feed failed', 'error') ]
+
+def writeMetrics(start, elapsed, flush):
+   """
+   args: start - time the run started
+         elapsed - seconds the run took
+         flush - seconds spent on writing queued mailboxes at the end
+   output: JSON lines appended to METRICSFILE, Prometheus textfile
+           written to PROMFILE; error text on Fail
+   returns: none
+   """
+
+   global _feedMetrics
+
+   feeds = _feedMetrics
+   _feedMetrics = []
+
+   if not METRICS: return
+
+   run = { 'type': 'run', 'time': int(start), 'seconds': elapsed,
+           'flush': flush, 'feeds': len(feeds), 'errors': 0,
+           'not_modified': 0 }
+   for key in _metricKeys:
+      run[key] = 0
+
+   lines = []
+   for stats in feeds:
+      feed = { 'type': 'feed', 'time': int(start), 'url': stats['url'],
+               'mbox': stats['mbox'], 'status': stats['status'],
+               'not_modified': int(stats['status'] == 304),
+               'error': stats['error'] }
+      for key in _metricKeys:
+         feed[key] = stats.get(key, 0)
+         run[key] = run[key] + feed[key]
+      run['errors'] = run['errors'] + feed['error']
+      run['not_modified'] = run['not_modified'] + feed['not_modified']
+      lines.append(jsonValue(feed) + '\n')
+   lines.append(jsonValue(run) + '\n')
+
+   if METRICSFILE:
+      try:
+         fp = file(METRICSFILE, 'a')
+         fp.write(string.join(lines, ''))
+         fp.close()
+      except:
+         print "Unable to write metrics file:", METRICSFILE
+
+   if not PROMFILE: return
+
+   out = []
+   for name, help, key in _promFeed:
+      out.append('# HELP syngen_feed_%s %s\n' % (name, help))
+      out.append('# TYPE syngen_feed_%s gauge\n' % name)
+      for stats in feeds:
+         if key == 'not_modified':
+            value = int(stats['status'] == 304)
+         else:
+            value = stats.get(key) or 0
+         out.append('syngen_feed_%s{feed="%s",mbox="%s"} %s\n' % \
+                    (name, _promLabel(stats['url']),
+                     _promLabel(stats['mbox']), value))
+
+   for name, help, value in (
+         ('timestamp_seconds', 'Time the last run started', int(start)),
+         ('seconds', 'Time the last run took', elapsed),
+         ('flush_seconds', 'Time spent writing queued mailboxes', flush),
+         ('feeds', 'Feeds processed', run['feeds']),
+         ('errors', 'Feeds that failed', run['errors']),
+         ('unchanged', 'Feeds fetched the same as the last time, not parsed',
+          run['unchanged']),
+         ('deferred', 'Feeds not fetched while they or their host fail',
+          run['deferred']),
+         ('bytes', 'Bytes of feed data received', run['bytes']),
+         ('new_entries', 'New articles written', run['new'])):
+      out.append('# HELP syngen_run_%s %s\n' % (name, help))
+      out.append('# TYPE syngen_run_%s gauge\n' % name)
+      out.append('syngen_run_%s %s\n' % (name, value))
+
+   # the collector may read it any time, never let it see half a file
+   try:
+      tmp = PROMFILE + '.new'
+      fp = file(tmp, 'w')
+      fp.write(string.join(out, ''))
+      fp.close()
+      os.rename(tmp, PROMFILE)
+   except:
+      print "Unable to write metrics file:", PROMFILE
+
+   return
+
+# Message Formatting Utilities -----------------------------------------
+
+# Messages are written straight from a template, header by header.  Only
+# headers that need encoding or folding are handed to the email package,
+# so the output stays what email.Message.as_string() would produce.
+
+_plainHeaderRe = re.compile(r'[\x21-\x7e]([\x20-\x7e]*[\x21-\x7e])?$')
+_8bitRe = re.compile('[\x80-\xff]')
+_mangleFromRe = re.compile('^From ', re.M)
+_charsets = {}
+_lastHeaders = {}   # name -> (value, encoded header) of the last call
+
+def formatHeader(name, value):
+   """
+   args: name - header name
+         value - header value, string or unicode
+   output: none
+   returns: header line(s) as a string, encoded and folded as needed
+   """
+
+   if isinstance(value, unicode):
+      try:
+         value = value.encode('us-ascii')
+      except UnicodeError:
+         pass
+
+   if isinstance(value, str) and _plainHeaderRe.match(value) and \
+         len(name) + len(value) + 2 <= 78:
+      return name + ': ' + value + '\n'
+
+   last = _lastHeaders.get(name)
+   if last is not None and last[0] == value:
+      return last[1]
+
+   if isinstance(value, str) and _8bitRe.search(value):
+      # raw 8bit data cannot be split safely, email leaves it alone
+      header = name + ': ' + value + '\n'
+   else:
+      header = email.Header.Header(value, maxlinelen=78,
+                                   header_name=name).encode()
+      header = name + ': ' + header + '\n'
+
+   # the From header repeats for every article of a feed
+   _lastHeaders[name] = (value, header)
+
+   return header
+
+def formatMessage(unixfrom, headers, ctype, charset, payload):
+   """
+   args: unixfrom - From_ line, without the leading 'From '
+         headers - list of (name, value) tuples
+         ctype - content type of payload, eg. 'text/html'
+         charset - character set of payload, eg. 'utf-8'
+         payload - message body, string encoded in charset
+   output: none
+   returns: message string in MBOX format, without separator
+   """
+
+   cset = _charsets.get(charset)
+   if cset is None:
+      cset = email.Charset.Charset(charset)
+      _charsets[charset] = cset
+
+   output = ['From ' + unixfrom + '\n']
+
+   for name, value in headers:
+      output.append(formatHeader(name, value))
+
+   output.append('MIME-Version: 1.0\n')
+   output.append('Content-Type: %s; charset="%s"\n' % \
+                 (ctype, cset.get_output_charset()))
+
+   cte = cset.get_body_encoding()
+   if cte:
+      output.append('Content-Transfer-Encoding: %s\n' % cte)
+      payload = cset.body_encode(payload)
+
+   output.append('\n')
+
+   # escape body lines that would read as the start of a new message
+   if 'From ' in payload:
+      payload = _mangleFromRe.sub('>From ', payload)
+   output.append(payload)
+
+   return string.join(output, "")
+
+# HTTP Fetch Utilities -------------------------------------------------
+
+# Connections are kept open per scheme, host and port and handed to one
+# request at a time.  Responses are decompressed while they are read and
+# refused once they grow past MAX_FETCH_BYTES.
+
+class ConnectionPool:
+   def __init__(self):
+      self.idle = {}       # (scheme, netloc) -> idle connections
+      self.lock = threading.Lock()
+
+   def get(self, scheme, netloc):
+      """
+      args: scheme - 'http' or 'https'
+            netloc - host[:port]
+      output: none
+      returns: (connection, reused) - an idle connection if there is
+               one, else a new one
+      """
+
+      self.lock.acquire()
+      try:
+         conns = self.idle.get((scheme, netloc))
+         if conns:
+            return conns.pop(), 1
+      finally:
+         self.lock.release()
+
+      return openConnection(scheme, netloc), 0
+
+   def put(self, scheme, netloc, conn):
+      self.lock.acquire()
+      try:
+         conns = self.idle.setdefault((scheme, netloc), [])
+         if len(conns) < POOL_SIZE:
+            conns.append(conn)
+            conn = None
+      finally:
+         self.lock.release()
+
+      if conn is not None:
+         conn.close()
+
+_pool = ConnectionPool()
+
+def openConnection(scheme, netloc):
+   """
+   args: scheme - 'http' or 'https'
+         netloc - host[:port]
+   output: none
+   returns: connected httplib connection, its reads limited to
+            FETCH_READ_TIMEOUT / raise exception
+   """
+
+   if scheme == 'https':
+      conn = httplib.HTTPSConnection(netloc, timeout = FETCH_CONNECT_TIMEOUT)
+   else:
+      conn = httplib.HTTPConnection(netloc, timeout = FETCH_CONNECT_TIMEOUT)
+
+   conn.connect()
+   conn.sock.settimeout(FETCH_READ_TIMEOUT)
+
+   return conn
+
+class FetchResponse:
+   """
+   A response from openURL(), read like a file.  Closing it after
+   reading it to the end returns its connection to the pool.
+   """
+
+   BUFSIZE = 8192
+
+   def __init__(self, url, scheme, netloc, conn, response):
+      self.url = url
+      self.scheme = scheme
+      self.netloc = netloc
+      self.conn = conn
+      self.response = response
+      self.status = response.status
+      self.headers = response.msg
+      self.buffer = []
+      self.buffered = 0
+      self.size = 0
+      self.eof = 0
+
+      encoding = string.lower(response.getheader('Content-Encoding', ''))
+      if encoding in ('gzip', 'x-gzip'):
+         self.decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+      elif encoding == 'deflate':
+         self.decoder = zlib.decompressobj()
+      else:
+         self.decoder = None
+      self.encoding = encoding
+
+   def getheader(self, name, default = None):
+      return self.headers.getheader(name, default)
+
+   def info(self):
+      return self.headers
+
+   def _decode(self, data):
+      try:
+         return self.decoder.decompress(data)
+      except zlib.error:
+         if self.encoding != 'deflate' or self.size:
+            raise
+         # some servers send deflate without the zlib header
+         self.decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+         return self.decoder.decompress(data)
+
+   def _fill(self):
+      data = self.response.read(self.BUFSIZE)
+
+      if not data:
+         self.eof = 1
+         if self.decoder:
+            data = self.decoder.flush()
+      elif self.decoder:
+         data = self._decode(data)
+
+      self.size += len(data)
+      if self.size > MAX_FETCH_BYTES:
+         self.close()
+         raise IOError("response larger than %d bytes: %s" % \
+                       (MAX_FETCH_BYTES, self.url))
+
+      if data:
+         self.buffer.append(data)
+         self.buffered += len(data)
+
+   def read(self, size = -1):
+      while not self.eof and (size < 0 or self.buffered < size):
+         self._fill()
+
+      data = string.join(self.buffer, "")
+      if size >= 0 and len(data) > size:
+         self.buffer = [data[size:]]
+         data = data[:size]
+      else:
+         self.buffer = []
+      self.buffered = self.buffered - len(data)
+
+      return data
+
+   def close(self):
+      if self.conn is None:
+         return
+
+      if self.eof and not self.response.will_close:
+         self.response.close()
+         _pool.put(self.scheme, self.netloc, self.conn)
+      else:
+         self.conn.close()
+
+      self.conn = None
+
+def pooledURL(url):
+   """
+   args: url - url or local file name
+   output: none
+   returns: true if url is fetched with openURL()
+   """
+
+   scheme, netloc = urlparse.urlparse(url)[0:2]
+
+   return HTTP_POOL and scheme in ('http', 'https') and '@' not in netloc
+
+def openURL(url, headers = None, redirects = 5):
+   """
+   args: url - http or https url
+         headers - dictionary of extra request headers
+         redirects - number of redirects to follow
+   output: none
+   returns: FetchResponse / raise exception
+   """
+
+   scheme, netloc, path, params, query, frag = urlparse.urlparse(url)
+   selector = urlparse.urlunparse(('', '', path or '/', params, query, ''))
+
+   request = { 'Accept-Encoding': 'gzip, deflate',
+               'User-Agent': 'SynGen/%s' % __version__ }
+   if headers:
+      request.update(headers)
+
+   conn, reused = _pool.get(scheme, netloc)
+   try:
+      conn.request('GET', selector, None, request)
+      response = conn.getresponse()
+   except (httplib.HTTPException, socket.error):
+      conn.close()
+      if not reused:
+         raise
+      # the server dropped the idle connection, try once on a new one
+      conn, reused = _pool.get(scheme, netloc)
+      while reused:
+         conn.close()
+         conn, reused = _pool.get(scheme, netloc)
+      conn.request('GET', selector, None, request)
+      response = conn.getresponse()
+
+   fp = FetchResponse(url, scheme, netloc, conn, response)
+
+   location = fp.getheader('Location')
+   if fp.status in (301, 302, 303, 307) and location and redirects:
+      fp.read()
+      fp.close()
+      return openURL(urlparse.urljoin(url, location), headers, redirects - 1)
+
+   return fp
+
+def fetchPipelined(urls, headers = None):
+   """
+   args: urls - http or https urls, all on one host
+         headers - dictionary of extra request headers
+   output: none
+   returns: dictionary of url -> (status, body) for the responses read
+            before the server closed the connection or one could not be
+            read / raise exception if none could be sent
+   """
+
+   # every request is sent before the first response is read, the
+   # connection is not shared so it is kept out of the pool
+   scheme, netloc = urlparse.urlparse(urls[0])[0:2]
+
+   request = { 'Host': netloc,
+               'Accept-Encoding': 'gzip, deflate',
+               'User-Agent': 'SynGen/%s' % __version__ }
+   if headers:
+      request.update(headers)
+
+   lines = []
+   for url in urls:
+      path, params, query = urlparse.urlparse(url)[2:5]
+      selector = urlparse.urlunparse(('', '', path or '/', params, query, ''))
+      lines.append('GET %s HTTP/1.1\r\n' % selector)
+      for name, value in request.items():
+         lines.append('%s: %s\r\n' % (name, value))
+      lines.append('\r\n')
+
+   conn = openConnection(scheme, netloc)
+
+   results = {}
+   try:
+      conn.sock.sendall(string.join(lines, ''))
+
+      # the responses read so far are kept whatever happens to the rest
+      try:
+         for url in urls:
+            response = httplib.HTTPResponse(conn.sock, method = 'GET')
+            response.begin()
+            fp = FetchResponse(url, scheme, netloc, None, response)
+            results[url] = (fp.status, fp.read())
+            if response.will_close:
+               break
+      except (socket.error, httplib.HTTPException, IOError):
+         pass
+   finally:
+      conn.close()
+
+   return results
+
+def conditionalHeaders(etag, modified):
+   """
+   args: etag - ETag of the last fetch, if any
+         modified - Last-Modified of the last fetch, if any
+   output: none
+   returns: dictionary of conditional GET request headers
+   """
+
+   headers = {}
+
+   if etag:
+      headers['If-None-Match'] = etag
+   if modified:
+      headers['If-Modified-Since'] = _httpDate(modified)
+
+   return headers
+
+def _httpDate(modified):
+   if isinstance(modified, tuple) or isinstance(modified, time.struct_time):
+      modified = time.strftime('%a, %d %b %Y %H:%M:%S GMT', modified)
+   return modified
+
+def fetchFeed(url, etag = None, modified = None, stats = None,
+              digest = None):
+   """
+   args: url - RSS url or local file name
+         etag - ETag of the last fetch, if any
+         modified - Last-Modified of the last fetch, if any
+         stats - dictionary to add 'fetch' and 'parse' seconds and
+                 'bytes' received to, optional
+         digest - bodyDigest() of the last body fetched, if any
+   output: none
+   returns: feedparser data dictionary, as by parseResponse() for http
+            urls / raise exception
+   """
+
+   if stats is None:
+      stats = {}
+
+   if not pooledURL(url):
+      # feedparser fetches it too, all of it counts as parse time
+      start = time.time()
+      newdata = feedparser.parse(url, etag, modified)
+      stats['parse'] = stats.get('parse', 0) + time.time() - start
+      return newdata
+
+   return parseResponse(fetchResponse(url, etag, modified, stats), stats,
+                        digest)
+
+def fetchResponse(url, etag = None, modified = None, stats = None):
+   """
+   args: url - http or https RSS url
+         etag - ETag of the last fetch, if any
+         modified - Last-Modified of the last fetch, if any
+         stats - dictionary to add 'fetch' seconds and 'bytes' received
+                 to, optional
+   output: none
+   returns: dictionary of the response: 'status', 'body', 'headers' for
+            feedparser, 'etag', 'modified' and 'href', the url after
+            redirects / raise exception
+   """
+
+   if stats is None:
+      stats = {}
+
+   start = time.time()
+   fp = openURL(url, conditionalHeaders(etag, modified))
+   body = fp.read()
+   fp.close()
+   stats['fetch'] = stats.get('fetch', 0) + time.time() - start
+   stats['bytes'] = stats.get('bytes', 0) + len(body)
+
+   # feedparser resolves relative links against the url it came from
+   headers = { 'content-location': fp.url }
+   if fp.getheader('Content-Type'):
+      headers['content-type'] = fp.getheader('Content-Type')
+
+   return { 'status': fp.status, 'body': body, 'headers': headers,
+            'etag': fp.getheader('ETag'),
+            'modified': fp.getheader('Last-Modified'), 'href': fp.url }
+
+def bodyDigest(body):
+   """
+   args: body - feed data as fetched
+   output: none
+   returns: (length, md5 hex digest) of body
+   """
+
+   return (len(body), md5.new(body).hexdigest())
+
+def parseResponse(response, stats = None, digest = None):
+   """
+   args: response - dictionary from fetchResponse(), 'status' may be None
+                    for a body fetched by other means
+         stats - dictionary to add 'parse' seconds to, optional
+         digest - bodyDigest() of the last body fetched, if any
+   output: none
+   returns: feedparser data dictionary with the 'digest' of the body, no
+            entries unless status was 200; no entries either, and
+            'unchanged' set, if the body is the same as the last one
+   """
+
+   if stats is None:
+      stats = {}
+
+   status = response['status']
+   if status is not None and status != 200:
+      return { 'feed': {}, 'entries': [], 'status': status }
+
+   # many servers send it all again rather than "304 Not Modified"
+   current = bodyDigest(response['body'])
+   if current == digest:
+      newdata = { 'feed': {}, 'entries': [], 'unchanged': 1 }
+   else:
+      start = time.time()
+      try:
+         newdata = feedparser.parse(response['body'],
+                                    response_headers=response['headers'])
+      except TypeError:
+         newdata = feedparser.parse(response['body'])
+      stats['parse'] = stats.get('parse', 0) + time.time() - start
+   newdata['digest'] = current
+
+   for key in ('status', 'etag', 'modified', 'href'):
+      if response.get(key) is not None:
+         newdata[key] = response[key]
+
+   return newdata
+
+# Bloglines Sync Utilities ---------------------------------------------
+
+# A run starts from the update call's unread count and ends there when
+# it is 0.  The subscription list is kept in BLOGSUBS rather than read
+# from listsubs every run; with it every subscription is asked for its
+# items and those with nothing unread answer 304.  Items are fetched
+# ahead BLOGLINES_PIPELINE subscriptions at a time on one connection, in
+# the order of the batch queued for the run.  The lock is not held while
+# they are fetched; threads wanting one of them wait for _blFetched.
+
+_blQueue = []          # subids of the batch, not yet fetched
+_blData = {}           # subid -> items fetched ahead, None if no unread
+_blFetching = sets.Set()   # subids being fetched ahead
+_blLock = threading.Lock()
+_blFetched = threading.Condition(_blLock)
+
+def blUnread():
+   """
+   args: none
+   output: none
+   returns: number of unread items, None if unknown / raise exception
+   """
+
+   url = updateUrl + urllib.quote(BLOGUSER)
+
+   if pooledURL(url):
+      f = openURL(url)
+   else:
+      f = urllib2.urlopen(url)
+   text = f.read()
+   f.close()
+
+   # |A|B|, A is -1 for an unknown user
+   try:
+      count = int(string.split(string.strip(text), '|')[1])
+   except (IndexError, ValueError):
+      return None
+
+   if count < 0:
+      return None
+
+   return count
+
+def blSubscriptions():
+   """
+   args: none
+   output: none
+   returns: dictionary of subid -> mbox name of the subscriptions that
+            may have unread items / raise exception
+   """
+
+   try:
+      unread = blUnread()
+   except:
+      unread = None
+
+   if unread == 0:
+      return {}
+
+   now = time.time()
+
+   # without a count there is no telling whether the list is stale
+   if unread is not None:
+      try:
+         kept = cPickle.loads(readState(BLOGSUBS))
+         if 0 <= now - kept['time'] < BLOGLINES_REFRESH:
+            return kept['subs']
+      except:
+         pass
+
+   feeds, subs = getBLfeeds(OPMLurl)
+
+   try:
+      writeState(BLOGSUBS, cPickle.dumps({ 'time': now, 'subs': subs }, 2))
+   except:
+      pass
+
+   return feeds
+
+def forgetBLsubs():
+   """
+   args: none
+   output: none
+   returns: none, the subscription list is read again next run
+   """
+
+   try:
+      removeState(BLOGSUBS)
+   except:
+      pass
+
+def queueBLdata(subids):
+   """
+   args: subids - Bloglines subids about to be processed, in order
+   output: none
+   returns: none
+   """
+
+   _blLock.acquire()
+   try:
+      _blQueue[:] = subids
+      _blData.clear()
+   finally:
+      _blLock.release()
+
+def fetchedBL(subid):
+   """
+   args: subid - Bloglines subid
+   output: none
+   returns: true if its items were fetched ahead and are waiting, or
+            are being fetched ahead
+   """
+
+   _blLock.acquire()
+   try:
+      return _blData.has_key(subid) or subid in _blFetching
+   finally:
+      _blLock.release()
+
+def prefetchedBL(subid):
+   """
+   args: subid - Bloglines subid
+   output: none
+   returns: (1, items or None if nothing is unread) when fetched ahead,
+            (0, None) when it is to be fetched on its own
+   """
+
+   _blLock.acquire()
+   try:
+      while subid in _blFetching:
+         _blFetched.wait()
+
+      batch = []
+      if not _blData.has_key(subid) and subid in _blQueue:
+         i = _blQueue.index(subid)
+         batch = _blQueue[i:i + BLOGLINES_PIPELINE]
+         del _blQueue[i:i + BLOGLINES_PIPELINE]
+         _blFetching.union_update(batch)
+   finally:
+      _blLock.release()
+
+   fetched = {}
+   try:
+      if batch:
+         fetched = fetchBLbatch(batch)
+   finally:
+      _blLock.acquire()
+      try:
+         _blData.update(fetched)
+         _blFetching.difference_update(batch)
+         _blFetched.notifyAll()
+
+         if _blData.has_key(subid):
+            result = (1, _blData.pop(subid))
+         else:
+            result = (0, None)
+      finally:
+         _blLock.release()
+
+   return result
+
+def fetchBLbatch(batch):
+   """
+   args: batch - Bloglines subids
+   output: none
+   returns: dictionary of subid -> items, None if nothing is unread, for
+            those fetched; errors are left to be fetched again on their
+            own to be reported
+   """
+
+   urls = [ feedUrl + s for s in batch ]
+   results = {}
+   if pooledURL(urls[0]):
+      try:
+         results = fetchPipelined(urls,
+                      { 'Authorization': 'Basic %s' % BasicAuth })
+      except (socket.error, httplib.HTTPException, IOError):
+         pass        # left to be fetched one at a time
+
+   fetched = {}
+   for s, url in zip(batch, urls):
+      if results.has_key(url):
+         status, data = results[url]
+         if status == 200:
+            fetched[s] = data
+         elif status == 304:
+            fetched[s] = None
+
+   return fetched
+
+# Streaming Feed Parser ------------------------------------------------
+
+# A SAX content handler that turns an RSS or Atom feed into the parts of
+# a feedparser result rssToMbox() uses.  Entries are collected as they
+# complete and taken away by FeedStream, so only a few are held at once.
+
+_entryTags = ('item', 'entry')
+_feedTags = ('channel', 'feed')
+# date elements and the feedparser keys they are parsed into; only
+# 'modified_parsed' dates a message, pubDate is 'published_parsed' from
+# feedparser 5 on, see _pubDateKey()
+_dateKeys = { 'updated': 'modified_parsed', 'modified': 'modified_parsed',
+              'date': 'modified_parsed', 'pubDate': None,
+              'published': 'published_parsed',
+              'issued': 'published_parsed', 'created': 'created_parsed' }
+_pubDateProbe = '<rss version="2.0"><channel><item><pubDate>' \
+                'Fri, 04 Jun 2004 12:00:00 GMT</pubDate></item></channel></rss>'
+_pubDateParsed = None
+_contentTypes = { 'html': 'text/html', 'xhtml': 'application/xhtml+xml',
+                  'text': 'text/plain' }
+
+class FeedHandler(xml.sax.ContentHandler):
+   def __init__(self):
+      xml.sax.ContentHandler.__init__(self)
+      self.startDocument()
+
+   def startDocument(self):
+      self.feed = { 'title': '', 'link': '' }
+      self.entries = []       # completed entries not yet taken
+      self.entry = None       # entry being parsed
+      self.stack = []         # local names of open elements
+      self.text = []          # character data of the current element
+      self.ctype = 'text/plain'
+      self.xhtml = 0          # depth inside inline xhtml content
+
+   def _target(self):
+      if self.entry is not None:
+         if self.stack and self.stack[-1] in _entryTags:
+            return self.entry
+      elif self.stack and self.stack[-1] in _feedTags:
+         return self.feed
+      return None
+
+   def startElementNS(self, name, qname, attributes):
+      uri, tag = name
+
+      if self.xhtml:
+         self.text.append('<' + tag)
+         for (auri, aname), value in attributes.items():
+            self.text.append(' %s=%s' % (aname,
+                             xml.sax.saxutils.quoteattr(value)))
+         self.text.append('>')
+         self.xhtml += 1
+         return
+
+      target = self._target()
+      self.text = []
+
+      if tag in _entryTags:
+         self.entry = {}
+      elif tag == 'link' and attributes.has_key((None, 'href')):
+         # Atom style link
+         href = attributes[(None, 'href')]
+         rel = attributes.get((None, 'rel'), 'alternate')
+         if target is None:
+            pass
+         elif rel == 'alternate' and not target.get('link'):
+            target['link'] = href
+         elif rel == 'enclosure' and target is self.entry:
+            self.entry.setdefault('enclosures', []).append({ 'url': href })
+      elif tag == 'enclosure' and target is self.entry:
+         if target is not None and attributes.has_key((None, 'url')):
+            self.entry.setdefault('enclosures', []).append(
+               { 'url': attributes[(None, 'url')] })
+      elif tag == 'content' or tag == 'encoded':
+         ctype = attributes.get((None, 'type'), 'html')
+         self.ctype = _contentTypes.get(ctype, ctype)
+         if ctype == 'xhtml':
+            self.xhtml = 1
+
+      self.stack.append(tag)
+
+   def endElementNS(self, name, qname):
+      uri, tag = name
+
+      if self.xhtml > 1:
+         self.text.append('</' + tag + '>')
+         self.xhtml -= 1
+         return
+      self.xhtml = 0
+
+      self.stack.pop()
+      text = string.join(self.text, '')
+      self.text = []
+
+      target = self._target()
+
+      if tag in _entryTags and self.entry is not None:
+         self.entries.append(self.entry)
+         self.entry = None
+      elif target is None:
+         pass
+      elif tag == 'title':
+         target.setdefault('title', text)
+         if target is self.feed and not self.feed['title']:
+            self.feed['title'] = text
+      elif tag == 'link':
+         if not target.get('link'):
+            target['link'] = string.strip(text)
+      elif target is self.feed:
+         pass
+      elif tag == 'guid' or tag == 'id':
+         target['guid'] = text
+      elif tag == 'description' or tag == 'summary':
+         target['description'] = _sanitize(text)
+      elif tag == 'content' or tag == 'encoded':
+         value = text
+         if self.ctype != 'text/plain':
+            value = _sanitize(text)
+         target.setdefault('content', []).append(
+            { 'type': self.ctype, 'value': value })
+      elif _dateKeys.has_key(tag):
+         key = _dateKeys[tag] or _pubDateKey()
+         parsed = _parseDate(string.strip(text))
+         if parsed:
+            target[key] = parsed
+
+   def characters(self, data):
+      if self.xhtml:
+         data = xml.sax.saxutils.escape(data)
+      self.text.append(data)
+
+def _sanitize(html):
+   """
+   args: html - unicode string
+   output: none
+   returns: html cleaned by feedparser's sanitizer, if it has one
+   """
+
+   sanitize = getattr(feedparser, '_sanitizeHTML', None)
+   if sanitize is None or not html:
+      return html
+
+   try:
+      result = sanitize(html, 'utf-8', u'text/html')
+   except TypeError:
+      result = sanitize(html, 'utf-8')
+
+   if isinstance(result, str):
+      result = unicode(result, 'utf-8')
+
+   return result
+
+def _pubDateKey():
+   """
+   args: none
+   output: none
+   returns: key feedparser gives an RSS pubDate under, 'modified_parsed'
+            before feedparser 5, 'published_parsed' since
+   """
+
+   global _pubDateParsed
+
+   if _pubDateParsed is None:
+      entries = feedparser.parse(_pubDateProbe)['entries']
+      if entries and entries[0].has_key('modified_parsed'):
+         _pubDateParsed = 'modified_parsed'
+      else:
+         _pubDateParsed = 'published_parsed'
+
+   return _pubDateParsed
+
+def _parseDate(text):
+   parse = getattr(feedparser, '_parse_date', None)
+   if parse is None:
+      return None
+   return parse(text)
+
+class FeedStream:
+   """
+   The entries of a feed, parsed a chunk at a time while they are
+   iterated over.  True if the feed has at least one entry.
+   """
+
+   BUFSIZE = 8192
+
+   def __init__(self, fp, stats = None):
+      self.fp = fp
+      if stats is None:
+         stats = {}
+      self.stats = stats      # 'bytes' read are added to it
+      self.handler = FeedHandler()
+      self.parser = xml.sax.make_parser()
+      self.parser.setFeature(xml.sax.handler.feature_namespaces, 1)
+      self.parser.setFeature(xml.sax.handler.feature_external_ges, 0)
+      self.parser.setContentHandler(self.handler)
+      self.done = 0
+
+      # read up to the first entry, the feed title comes before it
+      self._fill()
+
+   def _fill(self):
+      while not self.handler.entries and not self.done:
+         data = self.fp.read(self.BUFSIZE)
+         if data:
+            self.stats['bytes'] = self.stats.get('bytes', 0) + len(data)
+            self.parser.feed(data)
+         else:
+            self.parser.close()
+            self.fp.close()
+            self.done = 1
+
+   def __nonzero__(self):
+      return len(self.handler.entries) > 0
+
+   def close(self):
+      # the rest of the feed is not wanted
+      if not self.done:
+         self.fp.close()
+         self.done = 1
+      self.handler.entries = []
+
+   def __iter__(self):
+      while 1:
+         self._fill()
+         if not self.handler.entries:
+            break
+         entries = self.handler.entries
+         self.handler.entries = []
+         for entry in entries:
+            yield entry
+
+def streamFeed(url, etag = None, modified = None, stats = None):
+   """
+   args: url - RSS url or local file name
+         etag - ETag of the last fetch, if any
+         modified - Last-Modified of the last fetch, if any
+         stats - dictionary to add 'fetch' seconds and 'bytes' read to,
+                 optional; parsing happens while entries are taken
+   output: none
+   returns: feedparser like dictionary with 'feed', 'entries' and, for
+            HTTP, 'status', 'etag' and 'modified' / raise exception
+   """
+
+   data = {}
+
+   if stats is None:
+      stats = {}
+   start = time.time()
+
+   if pooledURL(url):
+      fp = openURL(url, conditionalHeaders(etag, modified))
+      data['status'] = fp.status
+
+      if fp.status != 200:
+         stats['bytes'] = stats.get('bytes', 0) + len(fp.read())
+         fp.close()
+         stats['fetch'] = stats.get('fetch', 0) + time.time() - start
+         data['feed'] = {}
+         data['entries'] = []
+         return data
+
+      data['etag'] = fp.getheader('ETag')
+      data['modified'] = fp.getheader('Last-Modified')
+   elif urlparse.urlparse(url)[0] in ('http', 'https', 'ftp', 'file'):
+      req = urllib2.Request(url)
+      for name, value in conditionalHeaders(etag, modified).items():
+         req.add_header(name, value)
+
+      try:
+         fp = urllib2.urlopen(req)
+      except urllib2.HTTPError, detail:
+         stats['fetch'] = stats.get('fetch', 0) + time.time() - start
+         data['status'] = detail.code
+         data['feed'] = {}
+         data['entries'] = []
+         return data
+
+      if hasattr(fp, 'code'):
+         data['status'] = fp.code
+      info = fp.info()
+      data['etag'] = info.getheader('ETag')
+      data['modified'] = info.getheader('Last-Modified')
+   else:
+      fp = file(url, 'r')
+
+   stats['fetch'] = stats.get('fetch', 0) + time.time() - start
+
+   stream = FeedStream(fp, stats)
+   data['feed'] = stream.handler.feed
+   data['entries'] = stream
+
+   return data
+
+class StreamBuffer:
+   """
+   Collects rendered messages for one mbox and queues them FLUSH_SIZE
+   bytes at a time.
+   """
+
+   def __init__(self, mbox, stats = None):
+      self.mbox = mbox
+      self.data = []
+      self.size = 0
+      if stats is None:
+         stats = {}
+      self.stats = stats      # 'write' seconds are added to it
+
+   def write(self, text):
+      """
+      args: text - rendered message
+      output: none
+      returns: true if it and all before it were queued
+      """
+
+      self.data.append(text)
+      self.size += len(text)
+      if self.size >= FLUSH_SIZE:
+         self.flush()
+         return 1
+      return 0
+
+   def flush(self):
+      if self.data:
+         start = time.time()
+         queueMailbox(self.mbox, string.join(self.data, ""))
+         self.stats['write'] = self.stats.get('write', 0) + \
+                               time.time() - start
+         self.data = []
+         self.size = 0
+
+# RSS Processing Functions ---------------------------------------------
+
+def formatFeedError(detail, url, note = None):
+   """
+   args: detail - detail string of error
+         url - RSS url 
+         note - text added at the end, optional
+   output: none
+   returns: error message as string in MBOX format
+   """
+
+   validate = urllib.quote(url)
+   detail = str(detail)
+
+   headers = [ ('From', '"SynGen RSS Aggregator" <SynGen@SynGen.rss>'),
+               ('To', '"RSS eMail Reader" <blogger@SynGen.rss>'),
+               ('Subject', 'Error in RSS Feed'),
+               ('Message-ID', '<' + url + '@feederror.syngen.rss>'),
+               ('Date', CURTIME) ]
+   payload = 'Problem parsing XML feed data.\n' + \
+            'Feed URL: ' + url + '\n' + \
+            'Error Detail: ' + detail + '\n' + \
+            'Check with Feed Validator: ' + \
+            'http://www.feedvalidator.org/check?url=' + validate + '\n'
+   if note:
+      payload = payload + note
+   payload = payload.encode('iso-8859-1')
+
+   output = formatMessage('SynGen@SynGen.rss ' + CURTIME, headers,
+                          'text/plain', 'iso-8859-1', payload)
+   output += '\n\n' # mbox seperator
+
+   return output
+
+def formatFeedRecovered(url, failures, since):
+   """
+   args: url - RSS url
+         failures - number of times in a row it failed
+         since - time it started failing
+   output: none
+   returns: message as string in MBOX format
+   """
+
+   headers = [ ('From', '"SynGen RSS Aggregator" <SynGen@SynGen.rss>'),
+               ('To', '"RSS eMail Reader" <blogger@SynGen.rss>'),
+               ('Subject', 'RSS Feed Working Again'),
+               ('Message-ID', '<' + url + '@feedrecovered.syngen.rss>'),
+               ('Date', CURTIME) ]
+   payload = 'Feed data received again.\n' + \
+            'Feed URL: ' + url + '\n' + \
+            'Failed ' + str(failures) + ' time(s) in a row, since ' + \
+            time.asctime(time.gmtime(since)) + '.\n'
+   payload = payload.encode('iso-8859-1')
+
+   output = formatMessage('SynGen@SynGen.rss ' + CURTIME, headers,
+                          'text/plain', 'iso-8859-1', payload)
+   output += '\n\n' # mbox seperator
+
+   return output
+
+def reportFeedError(detail, url, mbox):
+   """
+   args: detail - detail string of error
+         url - RSS url 
+         mbox - name of mailbox
+   output: none
+   returns: none / raise exception
+   """
+
+   queueMailbox(mbox, formatFeedError(detail, url))
+
+   return
+
+def articleText(article):
+   """
+   args: article - feedparser entry
+   output: none
+   returns: its html content if any, else its other content or its
+            description, '(none provided)' if it has neither
+   """
+
+   desc = ""
+
+   if article.has_key('content'):
+      clist = article['content']
+
+      # stop if we get html content, continue otherwise
+      for datum in clist:
+         if datum['type'] == "text/html":
+            desc = datum['value']
+            break
+         elif datum['type'] == "application/xhtml+xml":
+            desc = datum['value']
+            break
+         else: # probably "text/plain"
+            desc = datum['value']
+
+   if not len(desc):
+      if article.has_key('description'):
+         desc = article['description']
+
+   if not len(desc):
+      desc = '(none provided)'
+
+   return desc
+
+def articleGuid(article, desc):
+   """
+   args: article - feedparser entry
+         desc - its articleText()
+   output: none
+   returns: (guid, desc) - its guid, or failing that a hash of desc, and
+            desc, made ascii if it could not be hashed as it was
+   """
+
+   if article.has_key('guid'):
+      guid = string.strip(article['guid'])
+   else:
+      if isinstance(desc, unicode):
+         guidText = desc.encode('ascii', 'ignore')
+      else:
+         try:
+            guidText = str(desc)
+         except UnicodeError:
+            desc = unicode(desc, 'ascii', 'replace').encode('ascii')
+            guidText = desc
+
+      ml = md5.new(guidText)
+      guid = ml.hexdigest()
+      del ml
+
+   return guid, desc
+
+def rssToMbox(data, cfile = False, sink = None, stats = None, cache = None,
+              mark = None, keyed = None):
+   """
+   args: data - feedparser data dictionary
+         cfile - file and path to previously seen articles
+         sink - callable given each message as it is rendered, true
+                once it has queued them all, optional
+         stats - dictionary to count 'entries', 'new', 'dupes' and those
+                 of them 'shared' with other feeds, and entries 'skipped'
+                 by EARLY_STOP, in and collect the publication 'times' of
+                 new articles, optional
+         cache - articleCache() to use instead of cfile's, optional
+         mark - dictionary with the feed's 'watermark' and whether it is
+                'unsorted', as kept in its mfile, updated; None to look
+                at every entry
+         keyed - list to add (dedupeKeys(), message) of each new article
+                 to, with GLOBAL_DEDUPE, for the caller to check them
+                 against other feeds; optional
+   output: none
+   returns: output string, empty if sink was given or articles keyed
+   """
+
+   output = []
+
+   if stats is None:
+      stats = {}
+   for key in ('entries', 'new', 'dupes', 'shared', 'skipped'):
+      stats.setdefault(key, 0)
+   stats.setdefault('times', [])
+
+   # a feed found out of order last time is gone through in full, which
+   # tells whether it still is
+   if mark is not None and EARLY_STOP:
+      known = sets.Set(mark.get('watermark') or [])
+      trusted = not mark.get('unsorted', 0)
+   else:
+      known = sets.Set()
+      trusted = 0
+   unsorted = 0      # entries found out of order this time
+   newest = []       # guids of the first WATERMARK_SIZE entries
+   run = 0           # entries of the watermark in a row
+   below = 0         # an entry of the watermark came before
+   last = None       # date of the entry before
+   visited = 0
+
+   if cache is None and cfile:
+      cache = articleCache(cfile)
+
+   title = data['feed']['title']
+   if not title:
+      title = '(untitled)'
+
+   title = stripNewlines(string.strip(title))
+   title = unescapeEntities(title)
 
    clink = data['feed']['link']
 
    # need the following: feed - title, clink
    #                     item - date, ititle, guid, ilink, desc
+   # the title, link and date are only worked out for new articles
+   stopped = 0
    for article in data['entries']:
 
+      desc = articleText(article)
+      guid, desc = articleGuid(article, desc)
+
+      visited += 1
+      if len(newest) < WATERMARK_SIZE:
+         newest.append(guid)
+
+      # entries out of date order, or a new one below the watermark,
+      # mean the feed has to be gone through in full next time
+      if article.has_key('modified_parsed') and article['modified_parsed']:
+         when = calendar.timegm(article['modified_parsed'])
+         if last is not None and when > last:
+            unsorted = 1
+         last = when
+
+      if guid in known:
+         dupe = True
+         run += 1
+         below = 1
+      else:
+         if cache:
+            dupe = cache.checkDupe(guid)
+         else:
+            dupe = False
+
+         if not dupe and below:
+            unsorted = 1
+         run = 0
+
+      if not dupe and GLOBAL_DEDUPE:
+         keys = dedupeKeys(article.get('title'), desc, article.get('link'),
+                           clink)
+         if keyed is None and seenElsewhere(keys):
+            dupe = True
+            stats['shared'] += 1
+
+      stats['entries'] += 1
+
+      if dupe:
+         stats['dupes'] += 1
+         if run >= EARLY_STOP and trusted and not unsorted:
+            # a new entry at the end means the feed is oldest first; a
+            # stream's end cannot be looked at, it needs dates in order
+            entries = data['entries']
+            if not isinstance(entries, list):
+               if last is None:
+                  unsorted = 1
+            elif visited < len(entries):
+               tail = entries[-1]
+               tguid = articleGuid(tail, articleText(tail))[0]
+               if tguid not in known and \
+                     not (cache and cache.checkDupe(tguid, 0)):
+                  unsorted = 1
+            if not unsorted:
+               stopped = 1
+               break
+         continue
+
       if article.has_key('modified_parsed'):
          date = time.asctime(article['modified_parsed'])
       else:
          date = CURTIME
 
-      desc = ""
+      if article.has_key('title'):
+         ititle = articleTitle(article['title'], desc)
+      else:
+         ititle = articleTitle("", desc)
 
-      if article.has_key('content'):
-         clist = article['content']
+      if article.has_key('link'):
+         ilink = article['link']
+      elif article.has_key('guid'):
+         ilink = string.strip(article['guid'])
+      else:
+         ilink = clink
 
-         # stop if we get html content, continue otherwise
-         for datum in clist:
-            if datum['type'] == "text/html":
-               desc = datum['value']
-               break
-            elif datum['type'] == "application/xhtml+xml":
-               desc = datum['value']
-               break
-            else: # probably "text/plain"
-               desc = datum['value']
+      if article.has_key('enclosures') and article['enclosures']:
+         enclosure = True
+         fileURL = article['enclosures'][0]['url']
+      else:
+         enclosure = False
 
-      if not len(desc):
-         if article.has_key('description'):
-            desc = article['description']
+      stats['new'] += 1
+      if article.has_key('modified_parsed'):
+         stats['times'].append(calendar.timegm(article['modified_parsed']))
+
+      headers = [ ('From', '"' + title + '" <SynGen@SynGen.rss>'),
+                  ('To', '"RSS eMail Reader" <blogger@SynGen.rss>'),
+                  ('Subject', ititle),
+                  ('X-RSS-Link', ilink) ]
+      if enclosure:
+         headers.append(('X-RSS-Enclosure', fileURL))
+      headers.append(('Message-ID', '<' + guid + '@' + clink + '>'))
+      headers.append(('Date', date))
+      payload = u'<h4><a href="' + ilink + u'">'
+      payload += ititle + u'</a></h4>\n<p>\n'
+      payload += desc + u'\n</p>\n'
+      if enclosure:
+         payload += u'<p>[<a href="' + fileURL + u'">Enclosure</a>]</p>'
+      payload = payload.encode('utf-8')
+
+      message = formatMessage('SynGen@SynGen.rss ' + date, headers,
+                              'text/html', 'utf-8', payload)
+      message += '\n\n' # mbox seperator
+
+      if keyed is not None and GLOBAL_DEDUPE:
+         keyed.append((keys, message))
+      elif sink:
+         # articles queued are seen, even if the rest of a stream fails
+         if sink(message) and cache:
+            cache.save()
+      else:
+         output.append(message)
 
-      if not len(desc):
-         desc = '(none provided)'
+   # the rest of the feed is older still and not even looked at
+   if stopped:
+      entries = data['entries']
+      if isinstance(entries, FeedStream):
+         entries.close()
+      else:
+         stats['skipped'] += len(entries) - visited
+         stats['entries'] += len(entries) - visited
 
-      ititle = ""
+   if mark is not None and EARLY_STOP:
+      for guid in mark.get('watermark') or []:
+         if len(newest) >= WATERMARK_SIZE:
+            break
+         if guid not in newest:
+            newest.append(guid)
+      mark['watermark'] = newest
+      mark['unsorted'] = unsorted
 
-      if article.has_key('title'):
-         ititle = stripHtmlTags(article['title'])
+   if cache:
+      cache.save()
 
-      if not len(ititle):
-         ititle = firstNwords(stripHtmlTags(desc)) + "..."
+   return string.join(output, "")
 
-      ititle = xml.sax.saxutils.unescape(ititle, ENTITY_DICT)
-      ititle = string.strip(ititle)
+def renderFeed(url, mfile = False, cfile = False, sink = None, stats = None):
+   """
+   args: url - RSS url 
+         mfile - file and path to last modified data
+         cfile - file and path to previously seen articles
+         sink - callable given each new article as it is rendered,
+                optional
+         stats - dictionary to record the feed's metrics in, optional
+   output: none
+   returns: string in MBOX format, new articles or error report, may be
+            empty / raise exception
 
-      if article.has_key('link'):
-         ilink = article['link']
-      elif article.has_key('guid'):
-         ilink = string.strip(article['guid'])
+   Feeds that fail are not fetched before their retry time, nor feeds of
+   a host that keeps failing; see feedFailed() and hostSkipped().
+   """
+
+   if stats is None:
+      stats = {}
+
+   now = time.time()
+   host = feedHost(url)
+
+   # Bloglines feeds keep no state, their errors are reported every time
+   if not BLOGLINES:
+      mdata = readMfile(mfile)
+      if mdata.get('retry', 0) > now:
+         stats['deferred'] = 1
+         return ""
+   else:
+      mdata = None
+
+   # items fetched ahead are marked read already, they are not skipped
+   if not (BLOGLINES and fetchedBL(url)) and hostSkipped(host, now):
+      stats['deferred'] = 1
+      return ""
+
+   try:
+      output = _renderFeed(url, mdata, mfile, cfile, sink, stats)
+   except Exception, detail:
+      if hostFailure(detail):
+         hostFailed(host, time.time())
+
+      if isinstance(detail, FeedError):
+         detail = str(detail)
       else:
-         ilink = clink
+         detail = formatExceptionInfo()
+      stats['error'] = 1
+
+      if mdata is None:
+         return formatFeedError(detail, url)
+
+      output = feedFailed(url, mdata, detail, time.time())
+      writeMfile(mfile, mdata)
+      return output
+
+   hostWorked(host)
+
+   if mdata is not None and mdata.get('failures'):
+      output = feedRecovered(url, mdata, time.time()) + output
+      writeMfile(mfile, mdata)
+
+   return output
+
+def _renderFeed(url, mdata, mfile, cfile, sink, stats):
+   """
+   args: as renderFeed(), mdata - readMfile() data of the feed, None for
+         Bloglines
+   output: none
+   returns: string in MBOX format, new articles, may be empty / raise
+            exception, FeedError if the feed came back unusable
+   """
+
+   output = ""
+
+   # the watermark is kept with the rest of the feed's mfile data
+   mark = mdata
+
+   if _procPool is not None:
+      if BLOGLINES:
+         newdata = renderInPool(url, None, None, cfile, stats)
+      else:
+         newdata = renderInPool(url, mdata['etag'], mdata['modified'],
+                                cfile, stats, mark, mdata.get('digest'))
+   elif STREAMING:
+      if not BLOGLINES:
+         newdata = streamFeed(url, mdata['etag'], mdata['modified'], stats)
+      else:
+         start = time.time()
+         fp = openBLdata(url)
+         if fp is None:
+            newdata = { 'feed': {}, 'entries': [], 'status': 304 }
+         else:
+            stream = FeedStream(fp, stats)
+            newdata = { 'feed': stream.handler.feed, 'entries': stream }
+         stats['fetch'] = time.time() - start
+   elif not BLOGLINES:
+      newdata = fetchFeed(url, mdata['etag'], mdata['modified'], stats,
+                          mdata.get('digest'))
+   else:
+      start = time.time()
+      data = getBLdata(url)
+      stats['fetch'] = time.time() - start
+      stats['bytes'] = len(data)
+
+      start = time.time()
+      newdata = feedparser.parse(data)
+      stats['parse'] = time.time() - start
 
-      if article.has_key('guid'):
-         guid = string.strip(article['guid'])
-      else:
-         if isinstance(desc, unicode):
-            guidText = desc.encode('ascii', 'ignore')
-         else:
-            try:
-               guidText = str(desc)
-            except UnicodeError:
-               desc = unicode(desc, 'ascii', 'replace').encode('ascii')
-               guidText = desc
-
-         ml = md5.new(guidText)
-         guid = ml.hexdigest()
-         del ml
-      
-      if cfile:
-         dupe = checkDupe(cfile, guid)
+   status = newdata.get('status')
+   stats['status'] = status
+   stats['unchanged'] = newdata.get('unchanged', 0)
+
+   if newdata.has_key('error'):
+      raise FeedError(newdata['error'])
+
+   if newdata['entries']:
+      if newdata.has_key('output'):
+         output = newdata['output']    # rendered by a worker process
       else:
-         dupe = False
+         start = time.time()
+         output = rssToMbox(newdata, cfile, sink, stats, None, mark)
+         stats['render'] = time.time() - start
 
-      if article.has_key('enclosures'):
-         enclosure = True
-         fileURL = article['enclosures'][0]['url']
+      if BLOGLINES:
+         mdata = newdata
       else:
-         enclosure = False
+         mdata['etag'] = newdata.get('etag')
+         mdata['modified'] = newdata.get('modified')
+         mdata['digest'] = newdata.get('digest')
+      writeMfile(mfile, mdata)
+   elif status is not None:
+      if status > 399:
+         raise FeedError("received HTTP error " + str(status), status)
+
+      # a feed without entries is not parsed again while it stays so
+      current = newdata.get('digest')
+      if status == 200 and mdata is not None and current and \
+            not newdata.get('bozo') and current != mdata.get('digest'):
+         mdata['digest'] = current
+         writeMfile(mfile, mdata)
+   elif newdata.has_key('bozo_exception') and \
+         hostFailure(newdata['bozo_exception']):
+      raise newdata['bozo_exception']   # feedparser could not fetch it
+   else:
+      pass # let it go, could be xml error or not modified
 
-      if not dupe:
-         msg = email.Message.Message()
-         msg.set_unixfrom('From SynGen@SynGen.rss ' + date)
-         msg.add_header('From', '"' + title + '" <SynGen@SynGen.rss>')
-         msg.add_header('To', '"RSS eMail Reader" <blogger@SynGen.rss>')
-         msg.add_header('Subject', ititle)
-         msg.add_header('X-RSS-Link', ilink)
-         if enclosure:
-            msg.add_header('X-RSS-Enclosure', fileURL)
-         msg.add_header('Message-ID', '<' + guid + '@' + clink + '>')
-         msg.add_header('Date', date)
-         msg.set_type('text/html')
-         msg.set_charset('utf-8')
-         msg.epilogue = ''
-         payload = u'<h4><a href="' + ilink + u'">'
-         payload += ititle + u'</a></h4>\n<p>\n'
-         payload += desc + u'\n</p>\n'
-         if enclosure:
-            payload += u'<p>[<a href="' + fileURL + u'">Enclosure</a>]</p>'
-         payload = payload.encode('utf-8')
-         msg.set_payload(payload, 'utf-8')
-
-         output.append(msg.as_string(True))
-         output.append('\n\n') # mbox seperator
-         del msg
+   if ADAPTIVE_POLLING and not BLOGLINES:
+      scheduleFeed(mdata, time.time(), status, stats.get('new', 0),
+                   stats.get('times', []))
+      writeMfile(mfile, mdata)
 
-   return string.join(output, "")
+   return output
 
 def processFeed(url, mbox, mfile = False, cfile = False):
    """
@@ -717,27 +4605,29 @@ def processFeed(url, mbox, mfile = False, cfile = False):
    returns: none / raise exception
    """
 
-   if not BLOGLINES:
-      data = readMfile(mfile)
-      newdata = feedparser.parse(url, data['etag'], data['modified'])
-   else:
-      data = getBLdata(url)
-      newdata = feedparser.parse(data)
+   stats = feedStats(url, mbox)
+   start = time.time()
 
-   if len(newdata['items']):
-      output = rssToMbox(newdata, cfile)
+   try:
+      if STREAMING:
+         buffer = StreamBuffer(mbox, stats)
+         output = renderFeed(url, mfile, cfile, buffer.write, stats)
+         # the ids of what is left of a failed stream were not saved
+         if not stats.get('error'):
+            buffer.flush()
+      else:
+         output = renderFeed(url, mfile, cfile, None, stats)
 
       if len(output) > 0:
-         writeMailbox(mbox, output)
-      
-      writeMfile(mfile, newdata)
-   elif newdata.has_key('status'):
-      status = newdata['status']
-      if status > 399:
-         detail = "received HTTP error " + str(status)
-         reportFeedError(detail, url, mbox)
-   else:
-      pass # let it go, could be xml error or not modified
+         writeStart = time.time()
+         queueMailbox(mbox, output)
+         stats['write'] = stats.get('write', 0) + time.time() - writeStart
+   except:
+      stats['error'] = 1
+      stats['total'] = time.time() - start
+      raise
+
+   stats['total'] = time.time() - start
 
    return
 
@@ -753,14 +4643,14 @@ def getFeedInfo():
    fp.close()
    return data
 
-def checkFeeds():
+def feedJobs():
    """
    args: none
    output: error text on Fail
-   returns: 0 - Success, > 0 - Fail
+   returns: list of (url, mbox, mfile, cfile) feed jobs, None on Fail
    """
 
-   rc = 0
+   jobs = []
 
    if not BLOGLINES:
       try:
@@ -768,42 +4658,701 @@ def checkFeeds():
 
       except:
          print "Unable to open feedfile", FEEDFILE
-         rc = 1
-      else:
-         for line in string.split(data):
-            url, hash, mail = string.split(line, '|')
+         return None
+
+      for line in string.split(data):
+         url, hash, mail = string.split(line, '|')
 
-            cfile = CACHE + "/" + hash
-            mfile = MODIFIED + "/" + hash
-            mbox = MAILDIR + "/" + mail
+         if not inShard(hash):
+            continue
+
+         cfile = CACHE + "/" + hash
+         mfile = MODIFIED + "/" + hash
+         mbox = MAILDIR + "/" + mail
+
+         jobs.append((url, mbox, mfile, cfile))
+   else:
+      try:
+         # feeds[key] = val, key = bloglinesSubId, val = mbox name
+         feeds = blSubscriptions()
+      except:
+         print "Unable to get BlogLines OPML subscriptions", OPMLurl
+         return None
+
+      for subid in feeds.keys():
+         if not inShard(subid):
+            continue
+
+         mail = feeds[subid]
+         mbox = MAILDIR + "/" + mail
+
+         jobs.append((subid, mbox, False, False))
+
+   return jobs
+
+def runFeeds(jobs):
+   """
+   args: jobs - list of (url, mbox, mfile, cfile) feed jobs
+   output: error text on Fail
+   returns: 0 - Success, > 0 - Fail
+   """
+
+   rc = 0
+   start = time.time()
+   flush = 0
+
+   if HISTORY_FORMAT == 'ring' and STATE_BACKEND != 'files':
+      print "HISTORY_FORMAT 'ring' needs STATE_BACKEND 'files'"
+      return 1
+
+   if not LEASES:
+      batches = [ jobs ]
+   elif STATE_BACKEND != 'files':
+      print "LEASES needs STATE_BACKEND 'files'"
+      return 1
+   else:
+      batches = LeasedBatches(jobs, start)
+
+   for batch in batches:
+      if BLOGLINES:
+         queueBLdata([ job[0] for job in batch ])
 
+      if processPool() is not None:
+         # threads fetch and wait on the processes, keep them all busy
+         runConcurrent(batch, max(WORKERS, 2 * _procCount))
+      elif WORKERS > 1:
+         runConcurrent(batch)
+      else:
+         for url, mbox, mfile, cfile in batch:
             try:
                processFeed(url, mbox, mfile, cfile)
             except Exception, detail:
                detail = formatExceptionInfo()
                reportFeedError(detail, url, mbox)
+
+      flushStart = time.time()
+      if flushMailboxes():
+         rc = 1
+      flush += time.time() - flushStart
+
+   if BLOGLINES:
+      queueBLdata([])
+
+   writeMetrics(start, time.time() - start, flush)
+
+   return rc
+
+def checkFeeds():
+   """
+   args: none
+   output: error text on Fail
+   returns: 0 - Success, > 0 - Fail
+   """
+
+   rc = 0
+   now = time.time()
+
+   jobs = feedJobs()
+
+   if jobs is None:
+      rc = 1
+      jobs = []
+
+   if ADAPTIVE_POLLING:
+      jobs = [ job for job in jobs if feedDue(readMfile(job[2]), now) ]
+
+   if runFeeds(jobs):
+      rc = 1
+
+   syncState()
+
+   return rc
+
+# Lease Utilities ------------------------------------------------------
+
+# With LEASES, several SynGen processes may work through one feed list at
+# the same time.  A process claims a few feeds at a time by taking out a
+# lease on each in LEASEDB, a dbm only ever opened while LEASEDB.lock is
+# locked.  A lease record is "owner<TAB>expires<TAB>done": the process
+# holding it ("host:pid", empty once released), when the lease runs out
+# and when the feed was last finished.  A feed is claimed when it is not
+# leased, or its lease has expired or its owner is gone, and nobody has
+# finished it since the claiming run started.
+
+_leaseOwner = "%s:%d" % (socket.gethostname(), os.getpid())
+
+def _openLeases():
+   lock = file(LEASEDB + ".lock", 'a')
+   fcntl.lockf(lock.fileno(), fcntl.LOCK_EX)
+   try:
+      db = anydbm.open(LEASEDB, 'c')
+   except:
+      fcntl.lockf(lock.fileno(), fcntl.LOCK_UN)
+      lock.close()
+      raise
+   return lock, db
+
+def _closeLeases(lock, db):
+   db.close()
+   fcntl.lockf(lock.fileno(), fcntl.LOCK_UN)
+   lock.close()
+
+def leaseKey(job):
+   """
+   args: job - (url, mbox, mfile, cfile) feed job
+   output: none
+   returns: key of the feed's lease, its hash or Bloglines subid
+   """
+
+   if job[2]:
+      return os.path.basename(job[2])
+   return job[0]
+
+def ownerAlive(owner):
+   """
+   args: owner - "host:pid" of a lease
+   output: none
+   returns: 0 if owner is a process on this host that is gone, else 1
+   """
+
+   host, pid = string.split(owner, ':')
+   if host != socket.gethostname():
+      return 1           # can not tell, wait for the lease to expire
+
+   try:
+      os.kill(int(pid), 0)
+   except OSError, detail:
+      return detail.errno != errno.ESRCH
+
+   return 1
+
+def claimFeeds(jobs, since, count, next = 0):
+   """
+   args: jobs - list of (url, mbox, mfile, cfile) feed jobs
+         since - time this run started
+         count - most jobs to claim
+         next - index in jobs to start looking at
+   output: none
+   returns: (list of jobs claimed, index to continue from) / raise
+            exception
+   """
+
+   claimed = []
+   if not jobs:
+      return claimed, 0
+
+   lock, db = _openLeases()
+
+   try:
+      now = time.time()
+      for i in range(len(jobs)):
+         index = (next + i) % len(jobs)
+         job = jobs[index]
+         key = leaseKey(job)
+
+         done = 0
+         if db.has_key(key):
+            owner, expires, done = string.split(db[key], '\t')
+            done = float(done)
+            if done >= since:
+               continue
+            if owner and owner != _leaseOwner and float(expires) > now \
+                  and ownerAlive(owner):
+               continue
+
+         db[key] = "%s\t%f\t%f" % (_leaseOwner, now + LEASE_TIME, done)
+         claimed.append(job)
+
+         if len(claimed) >= count:
+            break
+   finally:
+      _closeLeases(lock, db)
+
+   return claimed, (index + 1) % len(jobs)
+
+def releaseFeeds(jobs):
+   """
+   args: jobs - list of feed jobs claimed by claimFeeds() and finished
+   output: none
+   returns: none / raise exception
+   """
+
+   lock, db = _openLeases()
+
+   try:
+      now = time.time()
+      for job in jobs:
+         key = leaseKey(job)
+         if db.has_key(key) and \
+               string.split(db[key], '\t')[0] == _leaseOwner:
+            db[key] = "\t0\t%f" % now
+   finally:
+      _closeLeases(lock, db)
+
+   return
+
+class LeasedBatches:
+   """
+   The jobs of a run, LEASE_BATCH at a time, as they are claimed.  Each
+   batch's leases are given up when the next one is asked for, after its
+   mailboxes and state have been written.
+   """
+
+   def __init__(self, jobs, since):
+      self.jobs = jobs
+      self.since = since
+
+   def __iter__(self):
+      next = 0
+      while True:
+         batch, next = claimFeeds(self.jobs, self.since, LEASE_BATCH, next)
+         if not batch:
+            break
+
+         yield batch
+
+         syncState()
+         releaseFeeds(batch)
+
+# Daemon Utilities -----------------------------------------------------
+
+_stopDaemon = 0
+_reloadFeeds = 0
+
+def _daemonSignal(signum, frame):
+   global _stopDaemon, _reloadFeeds
+
+   if signum == signal.SIGHUP:
+      _reloadFeeds = 1
    else:
+      _stopDaemon = 1
+
+def feedListStamp():
+   """
+   args: none
+   output: none
+   returns: (mtime, size) of FEEDFILE, None if it can not be read
+   """
+
+   try:
+      st = os.stat(FEEDFILE)
+   except:
+      return None
+
+   return (st.st_mtime, st.st_size)
+
+def runDaemon():
+   """
+   args: none
+   output: status and error messages
+   returns: 0 - stopped by signal
+
+   Keeps running, fetching each feed when it is due.  The feed list is
+   read again only when FEEDFILE changes (or on SIGHUP) and feed state
+   stays in memory, written out every STATE_SYNC_INTERVAL seconds.
+   SIGTERM or SIGINT make it finish the current cycle and exit.
+   """
+
+   global CURTIME, _reloadFeeds
+
+   signal.signal(signal.SIGTERM, _daemonSignal)
+   signal.signal(signal.SIGINT, _daemonSignal)
+   signal.signal(signal.SIGHUP, _daemonSignal)
+
+   # with LEASES other processes change feed state too, always read it
+   if not LEASES:
+      keepStateInMemory()
+
+   jobs = []
+   stamp = None
+   loaded = 0
+   nextPoll = {}          # url -> time the feed is next fetched
+   lastSync = time.time()
+
+   while not _stopDaemon:
+      now = time.time()
+      CURTIME = time.asctime(time.gmtime(now))
+
       try:
-         # feeds[key] = val, key = bloglinesSubId, val = mbox name
-         feeds = getBLfeeds(OPMLurl)
+         # Bloglines has no file to watch, re-read the OPML each interval
+         if BLOGLINES:
+            reload = now - loaded >= DAEMON_INTERVAL
+         else:
+            reload = feedListStamp() != stamp
+
+         if reload or _reloadFeeds:
+            _reloadFeeds = 0
+            newstamp = feedListStamp()
+            found = feedJobs()
+            if found is not None:
+               jobs, stamp, loaded = found, newstamp, now
+               if BLOGLINES:
+                  nextPoll = {}
+               print "SynGen: Loaded %d feeds" % len(jobs)
+
+         due = []
+         for job in jobs:
+            if ADAPTIVE_POLLING and job[2]:
+               if feedDue(readMfile(job[2]), now):
+                  due.append(job)
+            elif nextPoll.get(job[0], 0) <= now:
+               due.append(job)
+               nextPoll[job[0]] = now + DAEMON_INTERVAL
+
+         if due:
+            runFeeds(due)
+            os.utime(RUNFILE, None)
+
+         if time.time() - lastSync >= STATE_SYNC_INTERVAL:
+            syncState()
+            lastSync = time.time()
       except:
-         print "Unable to get BlogLines OPML subscriptions", OPMLurl
-         rc = 1
-      else:
-         for subid in feeds.keys():
-            mail = feeds[subid]
-            mbox = MAILDIR + "/" + mail
+         print "SynGen: Error in daemon cycle"
+         print formatExceptionInfo()
+
+      # sleep in short steps so a signal is acted on promptly
+      wake = now + DAEMON_TICK
+      while not _stopDaemon and not _reloadFeeds and time.time() < wake:
+         time.sleep(1)
+
+   print "SynGen: Shutting down"
+
+   flushMailboxes()
+   syncState()
+
+   return 0
+
+# Concurrent Processing ------------------------------------------------
+
+def feedHost(url):
+   """
+   args: url - RSS url or Bloglines subid
+   output: none
+   returns: lower case host name the feed is fetched from, '' if local
+   """
+
+   if BLOGLINES:
+      url = feedUrl + url
+
+   return string.lower(urlparse.urlparse(url)[1])
+
+def _feedWorker(todo, done):
+   """
+   args: todo - Queue of (index, url, mfile, cfile, stats) jobs, None to
+                stop
+         done - Queue receiving (index, output) results
+   output: none
+   returns: none
+   """
+
+   while True:
+      job = todo.get()
+      if job is None: break
+
+      index, url, mfile, cfile, stats = job
+      start = time.time()
+
+      try:
+         output = renderFeed(url, mfile, cfile, None, stats)
+      except Exception, detail:
+         output = formatFeedError(formatExceptionInfo(), url)
+         stats['error'] = 1
+
+      stats['total'] = time.time() - start
+      done.put((index, output))
 
-            mfile = False
-            cfile = False
+   return
+
+def runConcurrent(jobs, workers = None):
+   """
+   args: jobs - list of (url, mbox, mfile, cfile) in feedlist order
+         workers - number of threads, WORKERS if not given
+   output: none
+   returns: none / raise exception
+
+   Fetching, parsing and rendering run in WORKERS threads with at most
+   HOST_WORKERS of them talking to the same host.  Mailbox writes stay
+   in this thread and each mbox receives its feeds in feedlist order.
+   """
 
+   if workers is None:
+      workers = WORKERS
+
+   todo = Queue.Queue()
+   done = Queue.Queue()
+
+   threads = []
+   for i in range(min(workers, len(jobs))):
+      t = threading.Thread(target=_feedWorker, args=(todo, done))
+      t.setDaemon(True)
+      t.start()
+      threads.append(t)
+
+   hosts = []      # host of each job
+   waiting = {}    # host -> job indexes not yet started, in order
+   hostOrder = []
+   queued = {}     # mbox -> job indexes not yet written, in order
+
+   for index in range(len(jobs)):
+      url, mbox = jobs[index][0:2]
+      host = feedHost(url)
+      hosts.append(host)
+      if not waiting.has_key(host):
+         waiting[host] = []
+         hostOrder.append(host)
+      waiting[host].append(index)
+      queued.setdefault(mbox, []).append(index)
+
+   active = {}     # host -> running jobs
+   ready = {}      # job index -> rendered output
+   stats = {}      # job index -> feed metrics
+   running = 0
+   remaining = len(jobs)
+
+   while remaining:
+      # start as many jobs as the thread and per host limits allow
+      for host in hostOrder[:]:
+         while running < len(threads) and waiting[host] and \
+               active.get(host, 0) < HOST_WORKERS:
+            index = waiting[host].pop(0)
+            url, mbox, mfile, cfile = jobs[index]
+            stats[index] = feedStats(url, mbox)
+            todo.put((index, url, mfile, cfile, stats[index]))
+            active[host] = active.get(host, 0) + 1
+            running += 1
+         if not waiting[host]:
+            hostOrder.remove(host)
+
+      index, output = done.get()
+      running -= 1
+      active[hosts[index]] -= 1
+      ready[index] = output
+
+      # write everything this mbox has ready, without skipping ahead
+      mbox = jobs[index][1]
+      order = queued[mbox]
+      while order and ready.has_key(order[0]):
+         index = order.pop(0)
+         output = ready.pop(index)
+         remaining -= 1
+         if len(output) > 0:
+            start = time.time()
             try:
-               processFeed(subid, mbox)
+               queueMailbox(mbox, output)
             except Exception, detail:
                detail = formatExceptionInfo()
-               reportFeedError(detail, subid, mbox)
+               reportFeedError(detail, jobs[index][0], mbox)
+               stats[index]['error'] = 1
+            stats[index]['write'] = time.time() - start
+            stats[index]['total'] += stats[index]['write']
 
-   return rc
+   for t in threads:
+      todo.put(None)
+   for t in threads:
+      t.join()
+
+   return
+
+# Worker Process Utilities ---------------------------------------------
+
+# With PROCESS_POOL the feed threads of runConcurrent() fetch each feed
+# and hand the body, with a copy of the feed's seen article ids, to a
+# worker process.  It parses and renders the feed and returns the mbox
+# text and the ids of the new articles, with GLOBAL_DEDUPE their dedupe
+# keys too.  The article cache and the dedupe file are updated from
+# those here, so only this process ever writes state or mailboxes.
+
+_procPool = None
+_procCount = 0
+
+def processPool():
+   """
+   args: none
+   output: error text if the processes can not be started
+   returns: pool of worker processes, None if not configured or
+            available
+
+   Must be called before any threads are started, the processes are
+   forked from this one.
+   """
+
+   global _procPool, _procCount
+
+   if _procPool is None and PROCESS_POOL and not STREAMING and \
+         multiprocessing is not None:
+      try:
+         _procCount = PROCESSES or multiprocessing.cpu_count()
+         _procPool = multiprocessing.Pool(_procCount, _workerInit)
+      except:
+         print "Unable to start worker processes, parsing in threads"
+         _procCount = 0
+
+   return _procPool
+
+def _workerInit():
+   # interrupts and reloads are for the daemon, not its workers
+   signal.signal(signal.SIGINT, signal.SIG_IGN)
+   signal.signal(signal.SIGHUP, signal.SIG_IGN)
+   signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+def closeProcessPool():
+   """
+   args: none
+   output: none
+   returns: none
+   """
+
+   global _procPool
+
+   if _procPool is not None:
+      _procPool.close()
+      _procPool.join()
+      _procPool = None
+
+   return
+
+def renderResponse(url, response, etag, modified, ids, curtime,
+                   mark = None):
+   """
+   args: url - RSS url or local file name
+         response - dictionary from fetchResponse(), None to have
+                    feedparser fetch url
+         etag, modified - of the last fetch, used when response is None
+         ids - articles seen before, from loadHistory(), None to not
+               check
+         curtime - CURTIME of the run
+         mark - the feed's watermark, as rssToMbox() takes it, optional
+   output: none
+   returns: (result, stats, error detail) where result holds 'status',
+            'etag', 'modified', number of 'entries', the mbox 'output',
+            the new article ids 'added', the updated 'mark' and, with
+            GLOBAL_DEDUPE, the 'keyed' new articles instead of output;
+            error detail is None unless it failed
+
+   Runs in a worker process and leaves all state alone.
+   """
+
+   global CURTIME
+
+   CURTIME = curtime
+   stats = {}
+
+   try:
+      if response is None:
+         start = time.time()
+         newdata = feedparser.parse(url, etag, modified)
+         stats['parse'] = time.time() - start
+      else:
+         newdata = parseResponse(response, stats)
+
+      result = { 'status': newdata.get('status'),
+                 'etag': newdata.get('etag'),
+                 'modified': newdata.get('modified'),
+                 'entries': len(newdata['entries']), 'output': '',
+                 'added': [], 'mark': mark, 'keyed': [],
+                 'bozo': newdata.get('bozo', 0) }
+
+      if newdata['entries']:
+         if ids is not None:
+            cache = articleCache(None, ids)
+         else:
+            cache = None
+
+         start = time.time()
+         result['output'] = rssToMbox(newdata, False, None, stats, cache,
+                                      mark, result['keyed'])
+         stats['render'] = time.time() - start
+
+         if cache is not None:
+            result['added'] = cache.added
+   except:
+      return None, stats, formatExceptionInfo()
+
+   return result, stats, None
+
+def renderInPool(url, etag, modified, cfile, stats, mark = None,
+                 digest = None):
+   """
+   args: url - RSS url or Bloglines subid
+         etag - ETag of the last fetch, if any
+         modified - Last-Modified of the last fetch, if any
+         cfile - file and path to previously seen articles
+         stats - dictionary to record the feed's metrics in
+         mark - the feed's watermark, as rssToMbox() takes it, updated
+         digest - bodyDigest() of the last body fetched, if any
+   output: none
+   returns: feedparser like dictionary with 'status', 'etag', 'modified',
+            number of 'entries', the rendered 'output' and the body's
+            'digest', 'unchanged' set and no entries if it is digest, or
+            the 'error' detail if the worker process failed / raise
+            exception
+   """
+
+   current = None
+
+   if BLOGLINES:
+      start = time.time()
+      data = getBLdata(url)
+      stats['fetch'] = time.time() - start
+      stats['bytes'] = len(data)
+      response = { 'status': None, 'body': data, 'headers': {} }
+   elif pooledURL(url):
+      response = fetchResponse(url, etag, modified, stats)
+      if response['status'] != 200:
+         return { 'feed': {}, 'entries': [], 'status': response['status'] }
+
+      # nothing to hand to a worker if it is the same as last time
+      current = bodyDigest(response['body'])
+      if current == digest:
+         return { 'feed': {}, 'entries': [], 'status': 200,
+                  'unchanged': 1, 'digest': current }
+   else:
+      response = None
+
+   if cfile:
+      ids = loadHistory(cfile)
+   else:
+      ids = None
+
+   if mark is not None:
+      sent = { 'watermark': mark.get('watermark'),
+               'unsorted': mark.get('unsorted', 0) }
+   else:
+      sent = None
+
+   result, childStats, detail = _procPool.apply(renderResponse,
+      (url, response, etag, modified, ids, CURTIME, sent))
+
+   stats.update(childStats)
+
+   if detail is not None:
+      stats['error'] = 1
+      return { 'feed': {}, 'entries': [], 'status': None, 'error': detail }
+
+   if mark is not None and result['mark'] is not None:
+      mark.update(result['mark'])
+
+   # the dedupe file is only written here, articles go in feed order
+   if result['keyed']:
+      output = []
+      for keys, message in result['keyed']:
+         if seenElsewhere(keys):
+            stats['shared'] += 1
+            stats['dupes'] += 1
+            stats['new'] -= 1
+         else:
+            output.append(message)
+      result['output'] = string.join(output, "")
+
+   result['digest'] = current
+
+   if result['added']:
+      cache = articleCache(cfile)
+      for guid in result['added']:
+         cache.checkDupe(guid)
+      cache.save()
+
+   return result
 
 # ----------------------------------------------------------------------
 
@@ -814,20 +5363,56 @@ def main():
    returns: 0 - success, 1 - fail - uses sys.exit()
    """
 
-   if len(sys.argv) > 1:
-      if sys.argv[1] == "-cleanup":
+   global SHARD
+
+   args = sys.argv[1:]
+
+   # urllib2 and feedparser fetches have no timeouts of their own
+   socket.setdefaulttimeout(FETCH_READ_TIMEOUT)
+
+   if len(args) > 1 and args[0] in ("-shard", "--shard"):
+      try:
+         SHARD = parseShard(args[1])
+      except ValueError, detail:
+         print detail
+         sys.exit(1)
+      args = args[2:]
+
+   if len(args) > 0:
+      if args[0] == "-cleanup":
          cacheCleanup()
+      elif args[0] == "-reindex":
+         reindexMailboxes(args[1:])
+      elif args[0] == "-maintain":
+         maintainMailboxes(args[1:])
+      elif args[0] == "-search" and len(args) > 1:
+         searchArchive(args[1], string.join(args[2:]))
+      elif args[0] == "-extract" and len(args) > 1:
+         extractArchive(args[1], args[2:])
+      elif args[0] == "-daemon":
+         if checkFirstRun():
+            print "Sorry, please verify configuration options and retry"
+            sys.exit(1)
+
+         runDaemon()
+         closeProcessPool()
    else:
       if checkFirstRun():
          print "Sorry, please verify configuration options and retry"
          sys.exit(1)
 
-      if checkFeeds():
+      rc = checkFeeds()
+      closeProcessPool()
+
+      if rc:
          print "Error processing feeds, aborting"
          sys.exit(1)
       else:
          os.utime(RUNFILE, None)
 
+   closeState()
+   closeDedupe()
+
    sys.exit(0)
 
 if __name__ == '__main__':